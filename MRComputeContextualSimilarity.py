@@ -50,6 +50,8 @@ BZ2ShardedMothership.OutputFile = 'SIM-%s-%dw-min%dtwf-%d%s-%s.txt.bz2' % (Sourc
 
 
 class MyMapper(Mapper):
+    KeyFields = 2  # Each head word / target word pair is its own key
+
     def initialize(self, args):
         """ 
         Read in the set of headwords
@@ -64,7 +66,7 @@ class MyMapper(Mapper):
             logger.info(hw_file)
             # reader = codecs.getreader('utf8')(open(HeadWordsFile))
             # reader = codecs.open(hw_file, 'r', 'utf8', errors='replace')
-            reader = codecs.getreader('utf8')(BZ2File('%s-%s.lda.bz2' %
+            reader = open_result(self.local_copy('%s-%s.lda.bz2' %
                 (ContextMoniker, hw_file)))
             for line in reader.readlines():
                 tokens = line.strip().split('\t')
@@ -77,27 +79,19 @@ class MyMapper(Mapper):
         # Read in stop words
         logger.info('Reading in stop words...')
         self.stop_words = set()
-        reader = codecs.getreader('utf8')(BZ2File(StopWordsFile))
+        reader = open_result(self.local_copy(StopWordsFile))
         for line in reader.readlines():
             word = line.strip()
             self.stop_words.add(word)
 
         # Read in the term frequency information
         logger.info('Reading in term freq...')
-        self.unigram_term_freq = defaultdict(int)
-        self.unigram_doc_freq = defaultdict(int)
-        self.target_words = set()
-        self.good_words = set()
-        reader = codecs.getreader('utf8')(BZ2File(TermFreqFile))
-        for line in reader.readlines():
-            (word, tf, df) = line.split('\t')
-            self.unigram_term_freq[word] = int(tf)
-            self.unigram_doc_freq[word] = int(df)
-            if int(df) >= MinTargetWordDocFreq and not word in self.stop_words:
-                self.target_words.add(word)
-            if int(df) >= MinFeatureUnigramDocFreq:
-                self.good_words.add(word)
-        reader.close()
+        term_freq = self.side_table(self.local_copy(TermFreqFile), (int, int))
+        self.unigram_term_freq = term_freq.column(0)
+        self.unigram_doc_freq = term_freq.column(1)
+        self.target_words = term_freq.where(lambda word, (tf, df):
+                df >= MinTargetWordDocFreq and word not in self.stop_words)
+        self.good_words = term_freq.where(lambda word, (tf, df): df >= MinFeatureUnigramDocFreq)
 
         self.mapper_initialized = True
 
@@ -109,9 +103,10 @@ class MyMapper(Mapper):
             self.initialize_mapper()
 
         # Contains Jaccard top, jaccard bottom, wt top, wt bottom
-        collected_stats = {}
+        collected_stats = self.aggregator()
 
-        for (doc_count, (current_title, document)) in get_document_iterator(SourceDataType, token):
+        for (doc_count, (current_title, document)) in get_document_iterator(SourceDataType, self.open_input(token),
+                counter=self.counter):
              #keep_punctuation=True, filter_extraneous=True)):
             words = document.replace('<CR>', ' ').decode('ascii', 'replace').split()
             # print current_title, words
@@ -131,57 +126,46 @@ class MyMapper(Mapper):
                                     if k != i and words[k] in self.good_words:
                                         buffer[words[k]] += 1
                                 for hw, hw_features in self.head_words.iteritems():
-                                    collected_stats.setdefault((hw, w), [0,0,0,0])
+                                    stats = [0,0,0,0]
                                     for feature, c in buffer.iteritems():
                                         # Increment the tops if we find them
                                         if feature in hw_features:
-                                            collected_stats[(hw, w)][0] += 1
-                                            collected_stats[(hw, w)][2] += c / float(self.unigram_doc_freq[feature])
+                                            stats[0] += 1
+                                            stats[2] += c / float(self.unigram_doc_freq[feature])
                                         # Always increment the bottoms
-                                        collected_stats[(hw, w)][1] += 1
-                                        collected_stats[(hw, w)][3] += c / float(self.unigram_doc_freq[feature])
+                                        stats[1] += 1
+                                        stats[3] += c / float(self.unigram_doc_freq[feature])
+                                    collected_stats.add((hw, w), stats)
                         except UnicodeEncodeError:
                             sys.stderr.write('FAILED\n')
 
             if doc_count % 100 == 0:
                 logger.info('Processed %d documents' % doc_count)
 
-        for (hw, tw), stats in collected_stats.iteritems():
+        for (hw, tw), stats in collected_stats:
             self.output(u'%s\t%s\t%s' % (hw, tw, '\t'.join(map(str, stats))))
 
         # Return success
         return True
 
-    def reduce(self, data_heap):
+    def reduce_group(self, pair, values):
         """
-        This one collects word/context pairs and outputs to the LDA format
+        Add up the statistics of each head word / target word pair
         """
-        current = None
-        total_jac_bottom, total_jac_top, total_wt_jac_top, total_wt_jac_bottom = 0, 0, 0, 0
-        while data_heap:
-            (head, target, jac_top, jac_bottom, wt_jac_top, wt_jac_bottom) = heappop(data_heap).split('\t')
-
-            if current != (head,target):
-                if current:
-                    self.output('%s\t%s\t%d\t%f\t%f\t%d\t%f\t%f' % (head, target,
-                        total_jac_top, total_jac_bottom, total_wt_jac_top,
-                        total_wt_jac_bottom,
-                        total_jac_top/float(total_jac_bottom),
-                        total_wt_jac_top/float(total_wt_jac_bottom)))
-                    total_jac_bottom, total_jac_top, total_wt_jac_top, total_wt_jac_bottom = 0, 0, 0, 0
-
-                current = (head,target)
-
+        total_jac_top, total_jac_bottom, total_wt_jac_top, total_wt_jac_bottom = 0, 0, 0, 0
+        for value in values:
+            (jac_top, jac_bottom, wt_jac_top, wt_jac_bottom) = value.split('\t')
             total_jac_top += float(jac_top)
             total_jac_bottom += float(jac_bottom)
             total_wt_jac_top += float(wt_jac_top)
             total_wt_jac_bottom += float(wt_jac_bottom)
 
-        self.output('%s\t%s\t%d\t%d\t%f\t%f\t%f\t%f' % (head, target,
+        # A pair whose contexts had no features has nothing to divide by
+        self.output('%s\t%d\t%d\t%f\t%f\t%f\t%f' % (pair,
             total_jac_top, total_jac_bottom, total_wt_jac_top,
             total_wt_jac_bottom,
-            total_jac_top/float(total_jac_bottom),
-            total_wt_jac_top/float(total_wt_jac_bottom)))
+            total_jac_bottom and total_jac_top/float(total_jac_bottom),
+            total_wt_jac_bottom and total_wt_jac_top/float(total_wt_jac_bottom)))
                 
 UFOMapper     = MyMapper
 UFOMothership = BZ2ShardedMothership
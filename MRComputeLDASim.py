@@ -32,16 +32,11 @@ class MyMapper(Mapper):
         logger.info('Initializing mapper')
         self.map_initialized = True
 
-        self.RawFeatureVectors = self.args[0]
-        # os.popen('cp %s /tmp/' % (self.RawFeatureVectors))
-        # self.RawFeatureVectors = '/tmp/%s' % os.path.basename(self.RawFeatureVectors)
-
-        if self.RawFeatureVectors.endswith('.bz2'):
-            # self.RawFeatureVectors = codecs.getreader('utf8')(BZ2File(self.RawFeatureVectors))
-            self.RawFeatureVectors = BZ2File(self.RawFeatureVectors)
-        else:
-            # self.RawFeatureVectors = codecs.getreader('utf8')(open(self.RawFeatureVectors))
-            self.RawFeatureVectors = open(self.RawFeatureVectors)
+        # Read as bytes with open_result, which, unlike BZ2File, reads every
+        # stream of the file another job (or pipeline stage) wrote. It can't
+        # seek, so map() opens it again for each pass.
+        self.RawFeatureVectorsFile = self.local_copy(self.args[0])
+        self.RawFeatureVectors = open_result(self.RawFeatureVectorsFile, None)
 
         # HeadWords = set([x.strip('\n').split('\t')[0] for x in open(self.args[1]).readlines()])
         Similarity = self.args[1]
@@ -50,10 +45,12 @@ class MyMapper(Mapper):
         # with the original data, removing the untagged version of the word
         self.SecondaryRawFeatureVectorFiles = None
         if len(self.args) > 2:
-            self.SecondaryRawFeatureVectorFiles = map(BZ2File, self.args[2:])
+            self.SecondaryRawFeatureVectorFiles = [open_result(self.local_copy(path), None)
+                    for path in self.args[2:]]
 
         # Load the appropriate feature weighting and distance metric
         self.sim = load_similarity_metric(Similarity, self.RawFeatureVectors, self.SecondaryRawFeatureVectorFiles)
+        self.RawFeatureVectors.close()
 
         # self.raw_feature_pipe = self.RawFeatureVectors
         # self.RawFeatureVectors.seek(0)
@@ -78,7 +75,7 @@ class MyMapper(Mapper):
         # shard_heads = [x.strip('\n') for x in
         #         codecs.getreader('utf8')(BZ2File(token))]
         head_features = {}
-        for line in BZ2File(token):
+        for line in self.open_input(token, encoding=None):
             tokens = line.strip().split('\t')
             head, raw_head_features = tokens[0], tokens[1:]
             head_features[head] = self.sim.compute_feature_vector(head, raw_head_features)
@@ -87,7 +84,7 @@ class MyMapper(Mapper):
 
         # Now do the similarity computations
         # self.raw_feature_pipe.seek(0)
-        self.RawFeatureVectors.seek(0)
+        self.RawFeatureVectors = open_result(self.RawFeatureVectorsFile, None)
         for (i, line) in enumerate(self.RawFeatureVectors):
             if i % 100 == 0:
                 sys.stderr.write('Computed %d similarities\n' % i)
@@ -110,6 +107,7 @@ class MyMapper(Mapper):
                         heappush(sim_ranking_for[hw], (dist, target))
                     else:
                         heappushpop(sim_ranking_for[hw], (dist, target))
+        self.RawFeatureVectors.close()
 
         # Print out the results
         for (hw, friends) in sim_ranking_for.items():
@@ -26,52 +26,55 @@ BZ2ShardedMothership.OutputFile = '%s-term-doc-freq-%dw-%dv.txt.bz2' % (SourceDa
 BannedArticleTypes = ['Image:', 'Wikipedia:', 'Template:', 'Category:', 'File:']
 
 class MyMapper(Mapper):
+    RecordFormat = 'binary'  # (word, tf, df) records between map and reduce
+
     def map(self, token):
         logger.info('Mapping token [%r]' % token)
-        tf = defaultdict(int)
-        df = defaultdict(int)
+        counts = self.aggregator()  # word -> (tf, df)
 
-        reader = codecs.getreader('utf8')(BZ2File(token))
+        reader = self.open_input(token)
         for (doc_count, (current_title, document, _)) in enumerate(clean_wikipedia_documents(reader, BannedArticleTypes,
-             filter_extraneous=True)):
+             filter_extraneous=True, counter=self.counter)):
             terms = document.split()
             if len(terms) > MinDocLength:
+                tf = defaultdict(int)
                 for word in terms:
-                    tf[intern(word)] += 1
-                for word in set(terms):
-                    df[intern(word)] += 1
+                    tf[word] += 1
+                for (word, count) in tf.iteritems():
+                    counts.add(word, (count, 1))
+            else:
+                self.counter('documents', 'too short')
 
             # Report status
             if doc_count % 100 == 0:
                 logger.info('Processed %d documents' % doc_count)
 
         # Return results
-        for word in tf.iterkeys():
-            self.output(u'%s\t%d\t%d' % (word.decode('utf8'), tf[word],
-                df[word]))
+        for (word, (tf, df)) in counts:
+            self.emit(word, tf, df)
 
         # Return success
         return True
 
-    def reduce(self, data_heap):
+    ReduceWithCombiner = True  # The reducer sees one summed line per word
+
+    def combine(self, word, values):
+        """
+        Sum-combiner
+        """
+        total_tf, total_df = 0, 0
+        for (tf, df) in values:
+            total_tf += tf
+            total_df += df
+        return [(total_tf, total_df)]
+
+    def reduce(self, data):
         """
-        Sum-reducer
+        Threshold the summed counts
         """
-        total_df = defaultdict(int)
-        total_tf = defaultdict(int)
-        while data_heap:
-            try:
-                line = heappop(data_heap)
-                (word, tf, df) = line.split('\t')
-                total_df[word] += int(df)
-                total_tf[word] += int(tf)
-            except ValueError:
-                logger.error('error on line [%s]\n' % line.encode('ascii','ignore'))
-
-        for word in total_df.iterkeys():
-            if total_df[word] >= OutputDocumentFrequencyThreshold:
-                self.output('%s\t%d\t%d' % (word.encode('utf8'), total_tf[word],
-                    total_df[word]))
+        for (word, tf, df) in data:
+            if df >= OutputDocumentFrequencyThreshold:
+                self.emit(word, tf, df)
 
 UFOMapper     = MyMapper
 UFOMothership = BZ2ShardedMothership
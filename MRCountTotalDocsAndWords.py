@@ -32,11 +32,12 @@ class MyMapper(Mapper):
     def map(self, token):
         logger.info('Mapping token [%r]' % token)
 
-        reader = codecs.getreader('utf8')(BZ2File(token))
+        reader = self.open_input(token)
 
         words_found, docs_found = 0, 0
         docs_found = 0 
-        for (doc_count, (current_title, document)) in get_document_iterator(SourceDataType, token):
+        for (doc_count, (current_title, document)) in get_document_iterator(SourceDataType, reader,
+                counter=self.counter):
             words = document.split()
             if len(words) > MinDocLength:
                 docs_found += 1
@@ -51,17 +52,34 @@ class MyMapper(Mapper):
         # Return success
         return True
 
-    def reduce(self, data_heap):
-        current = None
-        occurrences = set()
+    def partition(self, key, partitions):
+        # Every count goes to the same reducer, so there is one total
+        return 0
+
+    def reduce(self, data):
         total_docs_found, total_words_found = 0, 0
-        while data_heap:
-            (docs_found, words_found) = heappop(data_heap).split('\t')
-            total_docs_found += docs_found
-            total_words_found += words_found
+        lines = 0
+        for line in data:
+            (docs_found, words_found) = line.split('\t')
+            total_docs_found += int(docs_found)
+            total_words_found += int(words_found)
+            lines += 1
+
+        # The other partitions are empty
+        if lines:
+            self.output('%d\t%d' % (total_docs_found, total_words_found))
+
+
+def check_total(path=BZ2ShardedMothership.OutputFile):
+    """
+    Check that the job wrote a single docs\twords total to path
+    """
+    lines = [line for line in open_result(path)]
+    if len(lines) != 1:
+        raise AssertionError('%s has %d lines, not one total' % (path, len(lines)))
+    (docs, words) = [int(field) for field in lines[0].split('\t')]
+    print '%s: %d documents, %d words' % (path, docs, words)
 
-        self.output('%d\t%d' % (total_docs_found, total_words_found))
-            
 
 
 UFOMapper     = MyMapper
@@ -69,4 +87,8 @@ UFOMothership = BZ2ShardedMothership
 
 if __name__ == '__main__':
     #psyco.full()
-    start_ufo(UFOMapper, UFOMothership)
+    import sys
+    if sys.argv[1:2] == ['--check']:
+        check_total(*sys.argv[2:])
+    else:
+        start_ufo(UFOMapper, UFOMothership)
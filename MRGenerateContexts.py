@@ -6,6 +6,7 @@ import re
 from ufo import *
 from string import lower
 from collections import defaultdict
+from itertools import groupby
 from sim_utils import parse_lda_entry
 
 ClientRegistry.Port = 62580 # port to connect to the mothership
@@ -80,7 +81,7 @@ class MyMapper(Mapper):
         logger.info('Reading in head words...')
         # reader = codecs.getreader('utf8')(open(HeadWordsFile))
         # reader = codecs.open(HeadWordsFile, 'r', 'utf8', errors='replace')
-        reader = codecs.getreader('utf8')(BZ2File(HeadWordsFile))
+        reader = open_result(self.local_copy(HeadWordsFile))
         for line in reader.readlines():
             word = line.strip().split('\t')[0]
             self.head_words.add(word)
@@ -88,7 +89,7 @@ class MyMapper(Mapper):
 
         self.stop_words = set()
         logger.info('Reading in stop words...')
-        reader = codecs.getreader('utf8')(BZ2File(StopWordsFile))
+        reader = open_result(self.local_copy(StopWordsFile))
         for line in reader.readlines():
             word = line.replace('\n', '')
 
@@ -100,7 +101,7 @@ class MyMapper(Mapper):
             self.good_contexts = set()
             if ContextCountsFile:
                 logger.info('Reading in good contexts...')
-                reader = codecs.getreader('utf8')(open(ContextCountsFile))
+                reader = codecs.getreader('utf8')(open(self.local_copy(ContextCountsFile)))
                 for line in reader.readlines():
                     context = line.split('\t')[0]
                     self.good_contexts.add(context)
@@ -108,14 +109,9 @@ class MyMapper(Mapper):
 
             # Read in the term frequency information
             logger.info('Reading in term freq...')
-            self.unigram_term_freq = defaultdict(int)
-            self.unigram_doc_freq = defaultdict(int)
-            reader = codecs.getreader('utf8')(BZ2File(TermFreqFile))
-            for line in reader.readlines():
-                (word, tf, df) = line.split('\t')
-                self.unigram_term_freq[word] = int(tf)
-                self.unigram_doc_freq[word] = int(df)
-            reader.close()
+            term_freq = self.side_table(self.local_copy(TermFreqFile), (int, int))
+            self.unigram_term_freq = term_freq.column(0)
+            self.unigram_doc_freq = term_freq.column(1)
 
     def map(self, token):
         # Stick these in here to hide them from ungoliant
@@ -124,8 +120,9 @@ class MyMapper(Mapper):
 
         logger.info('Mapping token [%r]' % token)
 
-        combined_counts = defaultdict(lambda: defaultdict(int))
-        for (doc_count, (current_title, document, _)) in get_document_iterator(SourceDataType, token):
+        combined_counts = self.aggregator()  # (head word, context word) -> count
+        for (doc_count, (current_title, document, _)) in get_document_iterator(SourceDataType, self.open_input(token),
+                counter=self.counter):
             words = document.replace('<CR>', ' ').split()
             # print current_title, words
             if len(words) > MinDocLength:
@@ -154,7 +151,7 @@ class MyMapper(Mapper):
                                 if OutputType == 'combined':
                                     assert not ContextType == 'raw'
                                     for k,v in buffer.iteritems():
-                                        combined_counts[w][intern(k.encode('ascii'))] += v
+                                        combined_counts.add((w, k.encode('ascii')), v)
                                 elif OutputType == 'occurrence':
                                     if ContextType == 'raw':
                                         context = u' '.join([k.decode('utf8') for k in buffer])
@@ -170,64 +167,45 @@ class MyMapper(Mapper):
 
         # Do intermediate combining for space efficiency
         if OutputType == 'combined':
-            for w, contexts in combined_counts.iteritems():
-                context = u'\t'.join([u'%s:%d' % (k,v) for k,v in contexts.iteritems()])
+            for w, contexts in groupby(combined_counts, lambda ((w, k), v): w):
+                context = u'\t'.join([u'%s:%d' % (k,v) for ((_, k), v) in contexts])
                 self.output(u'%s\t%s' % (w, context))
 
 
         # Return success
         return True
 
-    def reduce(self, data_heap):
+    def reduce_group(self, key, values):
         """
         Sum-reducer, for all the occurances of word/context, just make a count. This is where we can
         do things like thresholding.
         """
         if Phase == 1:
-            self.phase_one_reduce(data_heap)
+            self.phase_one_reduce(key, values)
         elif Phase == 2:
-            self.phase_two_reduce(data_heap)
-
-
-    def phase_one_reduce(self, data_heap):
-        current = None
-        occurrences = set()
-        while data_heap:
-            (context, _, word) = heappop(data_heap).partition('\t')
-            if current and context != current:
-                if len(occurrences) >= MinContextOccurranceThreshold:
-                    self.output('%s\t%s' % (current, len(occurrences)))
-                else:
-                    #self.output('POOP %s\t%s' % (current, len(occurrences)))
-                    pass
-                occurrences = set()
-            
-            current = context
-            occurrences.add(word)
-
-    def phase_two_reduce(self, data_heap):
+            self.phase_two_reduce(key, values)
+
+
+    def phase_one_reduce(self, context, words):
+        occurrences = set(words)
+        if len(occurrences) >= MinContextOccurranceThreshold:
+            self.output('%s\t%s' % (context, len(occurrences)))
+
+    def phase_two_reduce(self, word, values):
         """
         This one collects word/context pairs and outputs to the LDA format
         """
-        current = None
+        if OutputType == 'occurrence':
+            for context in values:
+                self.output(u'%s\t%s' % (word, context))
+            return
+
         occurrences = defaultdict(int)
-        while data_heap:
-            if OutputType == 'occurrence':
-                self.output(heappop(data_heap))
-            else:
-                tokens = heappop(data_heap).strip().split('\t')
-                word, contexts = tokens[0], map(parse_lda_entry, tokens[1:])
-
-                if current and word != current:
-                    self.output('%s\t%s' % (current, '\t'.join(['%s:%d' % (k,v)
-                        for (k,v) in occurrences.iteritems()])))
-                    occurrences = defaultdict(int)
-
-                current = word
-                for w,c in contexts:
-                    occurrences[w] += c
-
-        self.output('%s\t%s' % (current, '\t'.join(['%s:%d' % (k,v) for (k,v) in occurrences.iteritems()])))
+        for value in values:
+            for w,c in [parse_lda_entry(entry) for entry in value.strip().split('\t') if entry]:
+                occurrences[w] += c
+
+        self.output('%s\t%s' % (word, '\t'.join(['%s:%d' % (k,v) for (k,v) in occurrences.iteritems()])))
                 
 UFOMapper     = MyMapper
 UFOMothership = BZ2ShardedMothership
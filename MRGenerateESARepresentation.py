@@ -29,7 +29,7 @@ class MyMapper(Mapper):
 
         logger.info('Reading in clean words...')
 
-        reader = codecs.getreader('utf8')(BZ2File(HeadWords))
+        reader = open_result(self.local_copy(HeadWords))
         for line in reader.readlines():
             word = line.strip()
             if word:
@@ -40,21 +40,21 @@ class MyMapper(Mapper):
             
         
     def map(self, token):
-        word_index = defaultdict(int)
+        word_index = self.aggregator()  # (title, word) -> count
         document_size = defaultdict(int)
         vocab_size = defaultdict(int)
 
         logger.info('Mapping token [%r]' % token)
 
-        reader = codecs.getreader('utf8')(BZ2File(token))
+        reader = self.open_input(token)
 
         for (doc_count, (current_title, document, _)) in enumerate(clean_wikipedia_documents(reader, BannedArticleTypes,
-             filter_extraneous=False)):
+             filter_extraneous=False, counter=self.counter)):
             terms = document.split()
             if len(terms) > MinDocLength:
                 for w in terms:
                     if w in self.heads:
-                        word_index[(current_title, w)] += 1
+                        word_index.add((current_title, w))
                 document_size[current_title] = len(terms)
                 vocab_size[current_title] = len(set(terms))
             
@@ -71,7 +71,7 @@ class MyMapper(Mapper):
 
         reader.close()
 
-        for ((c,w), tf) in word_index.iteritems():
+        for ((c,w), tf) in word_index:
             self.output('%s\t%s\t%d\t%d\t%d' % (w,c,tf,document_size[c], vocab_size[c]))
 
         # Return success
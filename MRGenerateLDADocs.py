@@ -45,33 +45,18 @@ RestrictToCategories = [] # Article must contain [[Category:*@@@*]] where @@@ is
 
 class MyMapper(Mapper):
     def initialize(self, arg):
-        self.clean_words = set()
-
         logger.info('Reading in clean words...')
 
-        reader = codecs.getreader('utf8')(BZ2File(CleanWordsFile))
-        for line in reader.readlines():
-            (word,doc_count,_) = line.split('\t')
-            doc_count = int(doc_count)
-            if word and doc_count > MinVocabDocThreshold:
-                self.clean_words.add(word)
-        reader.close()
+        words = self.side_table(self.local_copy(CleanWordsFile), (int,))
+        self.clean_words = words.where(lambda word, (doc_count,): doc_count > MinVocabDocThreshold)
 
         logger.info('done.')
 
         # Read in document link weights
-        self.clean_docs = set()
-
         logger.info('Reading in clean docs...')
 
-        reader = codecs.getreader('utf8')(BZ2File(DocumentLinksFile))
-        for line in reader.readlines():
-            (doc,incoming,outgoing) = line.split('\t')
-            incoming = int(incoming)
-            outgoing = int(outgoing)
-            if doc and incoming >= MinIncomingLinkWeight:
-                self.clean_docs.add(doc)
-        reader.close()
+        docs = self.side_table(self.local_copy(DocumentLinksFile), (int, int))
+        self.clean_docs = docs.where(lambda doc, (incoming, outgoing): incoming >= MinIncomingLinkWeight)
 
         logger.info('done.')
             
@@ -92,10 +77,10 @@ class MyMapper(Mapper):
     def map(self, token):
         logger.info('Mapping token [%r]' % token)
 
-        reader = codecs.getreader('utf8')(BZ2File(token))
+        reader = self.open_input(token)
 
         for (doc_count, (current_title, document, flags)) in enumerate(clean_wikipedia_documents(reader, BannedArticleTypes,
-             filter_extraneous=False)):
+             filter_extraneous=False, counter=self.counter)):
             if current_title not in self.clean_docs:
                 continue
 
@@ -44,7 +44,7 @@ class MyShardedMothership(BZ2ShardedMothership):
         total_bigrams = 0
         for (i, shard) in enumerate(self.shuffle_result_shards):
             logger.info('  processing shard %d' % i)
-            f = codecs.getreader('utf8')(BZ2File(shard))
+            f = open_result(shard)
             for (line_no, line) in enumerate(f.readlines()): 
                 # print line.encode('utf8','replace'),
                 try:
@@ -66,7 +66,7 @@ class MyShardedMothership(BZ2ShardedMothership):
         writer = codecs.getwriter('utf8')(BZ2File(OutputFile, 'w'))
         for (i, shard) in enumerate(self.shuffle_result_shards):
             logger.info('  processing shard %d' % i)
-            f = codecs.getreader('utf8')(BZ2File(shard))
+            f = open_result(shard)
             for (line_no, line) in enumerate(f.readlines()): 
                 # print line.encode('utf8','replace'),
                 try:
@@ -92,6 +92,8 @@ class MyShardedMothership(BZ2ShardedMothership):
         sys.exit()
 
 class MyMapper(Mapper):
+    KeyFields = 2  # Each bigram is its own key
+
     def initialize(self):
         """ 
         Read in the set of clean words
@@ -114,7 +116,8 @@ class MyMapper(Mapper):
 
         doc_count = 0
         found_this_doc = set()
-        for document in get_document_iterator(DocumentSource, token):
+        for document in get_document_iterator(DocumentSource, self.open_input(token),
+                counter=self.counter):
             # Print out the result
             # print document.encode('utf8','replace')
 
@@ -142,31 +145,33 @@ class MyMapper(Mapper):
         logger.info('Success!')
         return True
 
-    def reduce(self, data_heap):
+    def combine(self, bigram, values):
         """
-        Sum up the occurrences
+        Sum up the occurrences of a bigram within one map shard
         """
-        prev_bigram = ''
         document_freq_sum = 0
         co_occurrence_sum = 0
-        while data_heap:
-            (word, word2, freq, doc_freq) = heappop(data_heap).split('\t')
-            # print 'read', word.encode('utf8','replace'), word2.encode('utf8','replace'), int(freq), int(doc_freq)
-            if (word,word2) != prev_bigram:
-                if prev_bigram != '':
-                    # Only output things that occur in more than OutputDocumentFrequencyThreshold documents 
-                    if co_occurrence_sum >= BigramFrequencyThreshold and document_freq_sum >= BigramDocumentThreshold:
-                        self.output('%s\t%s' % prev_bigram + '\t%d\t%d' % (co_occurrence_sum, document_freq_sum))
-                        # x = '%s\t%s' % prev_bigram
-                        # print 'write', x.encode('utf8','replace'), co_occurrence_sum, document_freq_sum
-
-                document_freq_sum = 0
-                co_occurrence_sum = 0
-                prev_bigram = (word,word2)
+        for value in values:
+            (freq, doc_freq) = value.split('\t')
+            co_occurrence_sum += int(freq)
+            document_freq_sum += int(doc_freq)
+        return ['%d\t%d' % (co_occurrence_sum, document_freq_sum)]
 
+    def reduce_group(self, bigram, values):
+        """
+        Sum up the occurrences
+        """
+        document_freq_sum = 0
+        co_occurrence_sum = 0
+        for value in values:
+            (freq, doc_freq) = value.split('\t')
             co_occurrence_sum += int(freq)
             document_freq_sum += int(doc_freq)
 
+        # Only output things that occur in more than OutputDocumentFrequencyThreshold documents 
+        if co_occurrence_sum >= BigramFrequencyThreshold and document_freq_sum >= BigramDocumentThreshold:
+            self.output('%s\t%d\t%d' % (bigram, co_occurrence_sum, document_freq_sum))
+
 UFOMapper     = MyMapper
 UFOMothership = MyShardedMothership
 
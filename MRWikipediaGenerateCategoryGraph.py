@@ -27,9 +27,10 @@ class MyMapper(Mapper):
 
         doc_count = 0
 
-        reader = codecs.getreader('utf8')(BZ2File(token))
+        reader = self.open_input(token)
 
-        for (doc_count, (current_title, categories)) in enumerate(extract_categories(reader, BannedArticleTypes)):
+        for (doc_count, (current_title, categories)) in enumerate(extract_categories(reader, BannedArticleTypes,
+                counter=self.counter)):
             output_set = set()
             for category in categories:
                 category = category.replace('[[','').replace(']]','')
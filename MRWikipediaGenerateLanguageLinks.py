@@ -54,9 +54,10 @@ class MyMapper(Mapper):
 
         doc_count = 0
 
-        reader = codecs.getreader('utf8')(BZ2File(token))
+        reader = self.open_input(token)
 
-        for (doc_count, (current_title, document, links, flags)) in get_document_iterator(SourceDataType, token, BannedArticleTypes):
+        for (doc_count, (current_title, document, links, flags)) in get_document_iterator(SourceDataType, reader, BannedArticleTypes,
+                counter=self.counter):
             document = document.replace('<CR>', ' ')
             split_doc = document.split()
             self.process(current_title, split_doc, links)
@@ -31,9 +31,10 @@ class MyMapper(Mapper):
 
         doc_count = 0
 
-        reader = codecs.getreader('utf8')(BZ2File(token))
+        reader = self.open_input(token)
 
-        for (doc_count, (current_title, document, links, flags)) in get_document_iterator(SourceDataType, token):
+        for (doc_count, (current_title, document, links, flags)) in get_document_iterator(SourceDataType, reader,
+                counter=self.counter):
             document = document.replace('<CR>', ' ')
             split_doc = document.split()
 
@@ -46,14 +46,8 @@ class MyMapper(Mapper):
         if MinIncomingLinks > 0:
             logger.info('Reading in clean docs...')
 
-            reader = codecs.getreader('utf8')(BZ2File(DocumentLinksFile))
-            for line in reader.readlines():
-                (doc,incoming,outgoing) = line.split('\t')
-                incoming = int(incoming)
-                outgoing = int(outgoing)
-                if doc and incoming >= MinIncomingLinks:
-                    self.clean_docs.add(doc)
-            reader.close()
+            docs = self.side_table(self.local_copy(DocumentLinksFile), (int, int))
+            self.clean_docs = docs.where(lambda doc, (incoming, outgoing): incoming >= MinIncomingLinks)
 
             logger.info('done.')
 
@@ -69,9 +63,10 @@ class MyMapper(Mapper):
 
         doc_count = 0
 
-        reader = codecs.getreader('utf8')(BZ2File(token))
+        reader = self.open_input(token)
 
-        for (doc_count, (current_title, document, links, _)) in get_document_iterator(SourceDataType, token):
+        for (doc_count, (current_title, document, links, _)) in get_document_iterator(SourceDataType, reader,
+                counter=self.counter):
             document = document.replace('<CR>', ' ')
 
             split_doc = document.split()
@@ -0,0 +1,63 @@
+"""
+Times a sort of the lines of a directory of bz2 shards end to end in --local
+mode, once for each combination of intermediate and final codec. Every line
+goes through the map outputs, the shuffle and the final merge, so the codecs'
+share of the job is about as large as it gets. e.g.
+
+    python benchmark_codecs.py /path/to/shards 20 8
+
+runs it over 20 shards in 8 local processes.
+"""
+import sys, os, time, subprocess
+from ufo import *
+
+IntermediateCodecs = ['bz2', 'gzip', 'raw']
+FinalCodecs = ['bz2', 'gzip']
+
+class SortMapper(Mapper):
+    IntermediateCodec = os.environ.get('UFO_INTERMEDIATE_CODEC', 'gzip')
+
+    def map(self, token):
+        for line in self.open_input(token):
+            self.output(line.rstrip('\n'))
+        return True
+
+class SortMothership(BZ2ShardedMothership):
+    FinalCodec = os.environ.get('UFO_FINAL_CODEC', 'bz2')
+    OutputFile = os.environ.get('UFO_OUTPUT_FILE', 'benchmark-codecs.txt')
+
+def remove_results(base_path, since):
+    """
+    Clean up the intermediate files a run left next to its input
+    """
+    for name in os.listdir(base_path):
+        path = os.path.join(base_path, name)
+        if name.find('-results.txt') >= 0 and os.path.getmtime(path) >= since:
+            os.remove(path)
+
+def benchmark(base_path, shards, processes):
+    print '%-14s%-10s%10s%14s' % ('intermediate', 'final', 'seconds', 'output bytes')
+    for intermediate in IntermediateCodecs:
+        for final in FinalCodecs:
+            output_file = 'benchmark-codecs-%s-%s.txt' % (intermediate, final)
+            env = dict(os.environ, UFO_INTERMEDIATE_CODEC=intermediate,
+                    UFO_FINAL_CODEC=final, UFO_OUTPUT_FILE=output_file)
+
+            started = time.time()
+            subprocess.check_call([sys.executable, sys.argv[0], '--job', base_path,
+                str(shards), '--shuffle', '--local', str(processes)], env=env)
+            elapsed = time.time() - started
+
+            print '%-14s%-10s%10.1f%14d' % (intermediate, final, elapsed,
+                    os.path.getsize(output_file))
+            os.remove(output_file)
+            remove_results(base_path, started)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--job':
+        del sys.argv[1]
+        start_ufo(SortMapper, SortMothership)
+    elif len(sys.argv) == 4:
+        benchmark(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]))
+    else:
+        print 'usage: %s shard_directory shards processes' % sys.argv[0]
@@ -1,129 +1,350 @@
 import socket, threading, time, sys
-import xmlrpclib, xmlrpcserver
 import os
+import multiprocessing
 import codecs 
 import string
+import zlib
+import shutil
+import json
+import copy
+import traceback
+from collections import deque
 from SocketServer import *
 from utils import logger, group
+from sorting import ExternalSorter, merge_runs, combine_records, write_run, read_run
+from inputs import InputReader, ReadSize
+from bz2blocks import split_shard, split_block_range
+from compression import get_codec, codec_for_path
+from records import get_format
+from wire import RpcServer, RpcProxy, ConnectionPool
+from journal import Journal, to_bytes
+from cache import LocalCache
+from status import StatusServer
+from sampling import KeySampler, pick_boundaries
+from sidedata import open_table
+from aggregate import Aggregator
+from fetch import shard_url, parse_url, failed_fetch, fetch_shards, read_chunk, shard_exists
+import tempfile
 from random import *
 from heapq import *
+from itertools import groupby
+from bisect import bisect_left
+import cPickle
 from bz2 import *
 
-FarmRate = 0.4
 UFOMothership = None
 UFOMapper     = None
 
-ShuffleKeysPerShard = 5  # The number of simultaneous shuffle steps to perform
-                          # on one data pass. (tradeoff speed for memory)
-# LoadPreviousResults = True
-LoadPreviousResults = False
+ShufflePartitions = 64  # The number of reduce partitions each map task writes;
+                        # one shuffle token is run per partition
+Journaling = True  # Journal completed tokens so a restarted Mothership only
+                   # reruns the ones that are missing
+
+SortBufferSize = 128 * 1024 * 1024  # Bytes of output to buffer before spilling
+                                    # a sorted run to disk
+SpillDirectory = None  # Where sorted runs are spilled (None is the system tmp dir)
+MergeFanIn     = 100   # Max number of sorted files merged at once
+WriteBatch     = 1000  # Records encoded before each write to an output file
+AggregateBufferSize = 128 * 1024 * 1024  # Bytes of partial sums each of a map's
+                                         # aggregator()s holds before spilling
+
+SampleTokens = 10    # Map tokens sampled for the boundaries of range
+                     # partitions, see Mothership.SortedOutput
+SampleSize   = 10000 # Keys kept from the output of each sampled token
+
+SpeculativeCopies = 2  # Max number of simultaneous attempts at one token
+ProgressRate = 10.0    # Seconds between polls of running tokens' progress
+
+HeartbeatRate    = 5.0    # Seconds between a client's heartbeats to the registry
+HeartbeatTimeout = 60.0   # A client silent for this long is taken for dead and
+                          # the tokens it was running are handed out again
+TaskTimeout      = 600.0  # A client kills a token that has read no input and
+                          # written no output for this many seconds
+MaxHostFailures  = 3      # Hosts whose clients fail this many times are
+                          # blacklisted for the rest of the job (None never is)
+MaxTokenAttempts = 4      # A token whose attempts fail this many times fails
+                          # the whole job (None retries it forever)
+
+LocalShuffle = True  # Keep map outputs on the local disk of the client that
+                     # wrote them, for reducers to fetch, rather than writing
+                     # them next to the input on shared storage, see ufo.fetch
+ShuffleDir   = None  # Where on each client's disk (None is the system tmp dir)
+FetchThreads = 4     # How many map outputs a reducer fetches at once
+
+SlowStartFraction = 0.8  # Start the reducers once this fraction of the map
+                         # tokens is done, so they fetch and merge map outputs
+                         # while the last maps finish (None waits for them all)
+MapOutputPoll = 2.0      # Seconds between an early reducer's requests for the
+                         # outputs of maps that finished since
+
+StatusPort    = 8642         # Port the Mothership serves its JSON status page
+                             # on (None turns it off), see ufo.status
+StatusHost    = 'localhost'  # Interface it listens on ('' is every interface)
+StatusSlowest = 10           # How many of the slowest running tokens it lists
+
+LocalCacheDir  = None  # Scratch directory on each worker for local copies of
+                       # inputs and side files (None turns caching off)
+LocalCacheSize = 20 * 1024 * 1024 * 1024  # Bytes the cache on each host may hold
+SideDataDir    = None  # Where each host keeps the tables made by side_table()
+                       # (None is LocalCacheDir, or else the system tmp dir)
 
 # Globals containing the current state of all the clients
 live_servers = []
-idle_servers = []
+idle_servers = deque()  # One entry per free slot
+host_caches = {}  # server -> set of input paths cached on that host
+last_heartbeat = {}  # (server, port) -> when we last heard from it
+host_failures = {}  # server -> how many times its clients have failed
+blacklisted_hosts = set()  # Servers we won't give any more work
 live_servers_lock = threading.Lock()
 
+# Tells clients registering again whether they're talking to the Mothership
+# they registered with or to one restarted since
+registry_id = '%s-%d-%d' % (socket.gethostname(), os.getpid(), time.time())
+
+current_job = None  # The Mothership whose tokens are running, for early reducers
+
+# Set whenever there may be new work to hand out or a newly free slot to give
+# it to; the Mothership sleeps on it between rounds of scheduling
+schedule_event = threading.Event()
+
+connection_pool = ConnectionPool()
+
 def get_rpc(server, port):
-    return xmlrpclib.ServerProxy("http://" + server + ":" + str(port) + "/")
+    return RpcProxy(connection_pool, (server, port))
+
+def list_shards(base_path):
+    """
+    The input shards in base_path: its .bz2 files, leaving out our own outputs
+    """
+    return ['%s/%s' % (base_path, file) for file in os.listdir(base_path)
+            if file.endswith('.bz2') and file.find('result') < 0]
+
+def open_result(path, encoding='utf8'):
+    """
+    Open a file written by ufo, e.g. a shuffle result or the output of an
+    earlier job, as a reader of unicode lines whatever codec it was written
+    with. Unlike BZ2File this reads every stream of a concatenated file.
+    Pass encoding=None to read bytes rather than unicode.
+    """
+    if encoding:
+        return codecs.getreader(encoding)(InputReader(path))
+    return InputReader(path)
+
+class TaskCancelled(Exception):
+    """ Raised inside a client when the Mothership cancels the token it is
+    working on """
+    pass
 
 class ClientRegistry(threading.Thread):
     """ Class to hold the list of currently available servers split into live
     and idle. """ 
     Port = None
-    
-    class Handler(StreamRequestHandler):
-        def handle(self):
-            server = self.rfile.readline(1024)
-            #logger.info( 'Got:' + server )
 
-            (server, port, updown) = server.split(' ')
-            port = int(port)
-            
-            live_servers_lock.acquire()
-            if updown == 'UP':
-                if not (server, port) in live_servers:
-                    live_servers.append((server, port))
-                if not (server, port) in idle_servers:
-                    idle_servers.append((server,port))
-            else:
-                if (server, port) in idle_servers:
-                    idle_servers.remove((server,port))
-                if (server,port) in live_servers:
-                    live_servers.remove((server,port))
-            
-            logger.info( "New server %s:%d" % (server,port) + " Live servers: " + str(len(live_servers)) + " idle: " + str(len(idle_servers)) )
+    def rpc_register(self, meta, server, port, slots=1, cached=[]):
+        """
+        A client can run slots tokens at once, so it goes on the idle list
+        once per slot; registering again offers more. cached lists the
+        inputs already in its host's cache. Returns our registry_id, or False
+        if its host is blacklisted.
+        """
+        live_servers_lock.acquire()
+        if server in blacklisted_hosts:
+            logger.warning('Refusing server %s:%d; its host is blacklisted' % (server, port))
+            live_servers_lock.release()
+            return False
+        host_caches[server] = set(cached)
+        last_heartbeat[(server, port)] = time.time()
+        news = 'New'
+        if not (server, port) in live_servers:
+            live_servers.append((server, port))
+        else:
+            news = 'More slots from'
+        idle_servers.extend([(server, port)] * slots)
+        logger.info( "%s server %s:%d (%d slots)" % (news,server,port,slots) + " Live servers: " + str(len(live_servers)) + " idle: " + str(len(idle_servers)) )
+        live_servers_lock.release()
+        schedule_event.set()
+        return registry_id
+
+    def rpc_unregister(self, meta, server, port):
+        live_servers_lock.acquire()
+        while (server, port) in idle_servers:
+            idle_servers.remove((server,port))
+        if (server,port) in live_servers:
+            live_servers.remove((server,port))
+        last_heartbeat.pop((server, port), None)
+        logger.info( "Lost server %s:%d" % (server,port) + " Live servers: " + str(len(live_servers)) + " idle: " + str(len(idle_servers)) )
+        live_servers_lock.release()
+        connection_pool.discard((server, port))
+        return True
+
+    def rpc_heartbeat(self, meta, server, port):
+        """
+        A client telling us it is still alive. Returns False if we don't
+        count it as live, in which case it should register again.
+        """
+        live_servers_lock.acquire()
+        try:
+            if (server, port) not in live_servers:
+                return False
+            last_heartbeat[(server, port)] = time.time()
+            return True
+        finally:
             live_servers_lock.release()
         
+    def rpc_map_outputs(self, meta, base_path, partition):
+        """
+        What a reducer started before the end of the map phase asks for, see
+        Mothership.map_outputs
+        """
+        if not current_job:
+            raise ValueError('No task is running')
+        return current_job.map_outputs(base_path, partition)
+
     def run(self):
         address = ('', ClientRegistry.Port)
-        server = ThreadingTCPServer(address, self.Handler)
+        server = RpcServer(address)
+        server.register('register', self.rpc_register)
+        server.register('unregister', self.rpc_unregister)
+        server.register('heartbeat', self.rpc_heartbeat)
+        server.register('map_outputs', self.rpc_map_outputs)
         logger.info( "starting server at (%s,%s) " % (address) )
         try:
             server.serve_forever()
         except:
             logger.error( "Handle server died!" )
 
-def sendto(request, address):
-    """
-    Send a message request to address 
-    """
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-	s.connect(address)
-        s.send(request)
-	s.close()
-        return True
-    except IOError, (errno, strerr):
-        logger.error( strerr )
-        return False
-
 
 class Token:
     """ Tokens hold information regarding what evals have been farmed out, and
     how many are remaining for each organism."""
     def __init__(self):
         self.farmed    = False
+        self.started   = {}  # (server, port) -> start time of each running attempt
+        self.progress  = {}  # (server, port) -> last reported fraction complete
+        self.read_all  = {}  # (server, port) -> when it had read all its input
+        self.failures  = []  # (server, port) of each attempt that raised an error
+
+
+class ChildTask:
+    """ A token being run by a client in a child process. progress and
+    cancelled live in shared memory so the client can read the one and set
+    the other while the child works. """
+    def __init__(self, kind, token):
+        self.kind      = kind
+        self.token     = token
+        self.started   = time.time()
+        self.progress  = multiprocessing.Value('d', -1.0, lock=False)
+        self.cancelled = multiprocessing.Value('b', 0, lock=False)
+        # When it last read input or wrote output, see TaskTimeout
+        self.active    = multiprocessing.Value('d', self.started, lock=False)
+        self.process   = None
 
 
 class Mapper:
     """ Abstract base class for a generic client """
     Port = None
     Handlers = None # Handler function for each kind of token
+
+    Slots = 1  # How many tokens a client runs at once, each in its own child
+               # process
+
+    KeyFields = 1  # How many leading tab separated fields make up the key
+
+    # Subclasses may define combine(self, key, values), taking an iterator
+    # over the rest of each line with that key and returning the lines to use
+    # in their place. It is run on map output before it is spilled.
+    combine = None
+    ReduceWithCombiner = False  # Also run the combiner over the merged input
+                                # of each reducer (it must be associative)
+
+    # Subclasses may define reduce_group(self, key, values) in place of
+    # reduce. It is called once per key with a lazy iterator over the values
+    # for that key, in the form combine() gets them. Records are sorted whole,
+    # so the values come in sorted order: to have them sorted on some field
+    # (a secondary sort), make it the first field of the value. Binary records
+    # compare numbers as numbers; text compares everything as strings.
+    reduce_group = None
+
+    IntermediateCodec = 'gzip'  # Codec for map and shuffle outputs, see
+                                # ufo.compression
+
+    # 'text' passes tab separated lines from map to reduce; with 'binary'
+    # records are tuples of typed fields instead, see ufo.records. Binary jobs
+    # output with emit(), and reduce() and combine() get tuples.
+    RecordFormat = 'text'
     
     def __init__(self, mothership, args):
         """ 
-        Carefully initialize the connection to the Mothership and register all
-        methods defined by the subcless.
+        Set up the job; serve() then connects to the Mothership. mothership is
+        None when running in a local worker process.
         """
+        self.format = get_format(self.RecordFormat)
+        self.cache = None
+        if LocalCacheDir:
+            self.cache = LocalCache(LocalCacheDir, LocalCacheSize)
+
         self.initialize(args)
 
-        self.shuffle_keys = set()  # Contains the local set of shuffle keys
         self.stopped = False
 
-        self.Port = randint(40000,90000)
+        self.tasks = {}  # (kind, token) -> ChildTask for everything running
+        self.tasks_lock = threading.Lock()
+        self.registry = None  # registry_id of the Mothership we registered with
+        self.orphans = set()  # Keys of tasks whose calls came from a Mothership
+                              # that has since been restarted
+        self.task = None  # Inside a child, the ChildTask it is running
+        self.input = None  # InputReader for the current map token, if any
+        self.counters = {}  # group -> name -> count for the current token
+        self.phase = 'map'  # Or 'reduce', for the built in counters
+        self.boundaries = None  # Keys splitting the range partitions, if any
+        self.aggregators = []  # Those made by the current map token
+        self.rpcserver = None
+
+        # These name our output files; serve() replaces the pid with our port
+        self.hostname = socket.gethostname()
+        self.Port = os.getpid()
         self.mothership = mothership
+
+    def serve(self):
+        """ 
+        Carefully initialize the connection to the Mothership and register all
+        methods defined by the subcless, then handle calls until terminated.
+        """
+        self.Port = randint(40000,65000)
+        mothership = self.mothership
     
         try:
-            self.hostname = socket.gethostname()
-
             # Ensure that we can set up a server or we die trying
             down = True
             while down:
                 try:
-                    logger.info( '%s:%d notifying %s of startup' % (socket.gethostname(), self.Port, mothership) )
-                    sendto(socket.gethostname()+' '+str(self.Port)+' UP', (mothership, ClientRegistry.Port))
-                    rpcserver = xmlrpcserver.XmlRpcHTTPServer((socket.gethostname(),self.Port))
+                    rpcserver = RpcServer((socket.gethostname(),self.Port))
+                    # Wake up regularly so we notice when we've been stopped
+                    rpcserver.timeout = 1.0
+                    self.rpcserver = rpcserver
                     down = False
+                except socket.error:
+                    logger.warning( 'Couldnt bind to port %d' % self.Port )
+                    self.Port = randint(40000,65000)
+
+            self.register_rpcs(rpcserver)
+
+            # Only tell the mothership about us once we can take calls
+            while True:
+                try:
+                    logger.info( '%s:%d notifying %s of startup' % (socket.gethostname(), self.Port, mothership) )
+                    accepted = self.register(self.Slots)
+                    break
                 except socket.error:
                     logger.warning( 'Couldnt connect to mothership ' + mothership )
-                    self.Port = randint(40000,90000)
                     time.sleep(1)
-            
-            # to register an object, do rpcserver.register('rpcname',object)
-            # to register a method, do rpcserver.register('rpcname',method)
-            rpcserver.register('map',self.rpc_map)
-            rpcserver.register('shuffle',self.rpc_shuffle)
-            rpcserver.register('terminate',self.rpc_terminate)
+            if not accepted:
+                logger.error( 'Mothership %s has blacklisted this host' % mothership )
+                return
+
+            heartbeats = threading.Thread(target=self.send_heartbeats)
+            heartbeats.daemon = True
+            heartbeats.start()
 
             logger.info( 'Client setup complete.' )
 
@@ -133,118 +354,699 @@ class Mapper:
         finally: # cleanup no matter what happens
             self.terminate()
 
+    def register(self, slots):
+        """
+        Offer slots to the Mothership's registry; False if it won't have us
+        """
+        registry = get_rpc(self.mothership, ClientRegistry.Port).register(self.hostname, self.Port,
+                slots, self.cached_inputs())
+        if registry:
+            self.registry = registry
+        return registry
+
+    def send_heartbeats(self):
+        """
+        Tell the registry we're alive every HeartbeatRate seconds, and kill
+        the children of tokens that have stalled. If the registry has given
+        up on us, register again with the slots that are free; the rest come
+        back as their tokens finish. If the Mothership was restarted, nobody
+        is waiting for the tokens still running, so we offer their slots
+        ourselves as they finish.
+        """
+        while not self.stopped:
+            time.sleep(HeartbeatRate)
+            self.kill_stalled_tasks()
+            try:
+                if get_rpc(self.mothership, ClientRegistry.Port).heartbeat(self.hostname, self.Port):
+                    continue
+                self.tasks_lock.acquire()
+                free = self.Slots - len(self.tasks)
+                busy = set(self.tasks)
+                self.tasks_lock.release()
+                logger.warning( 'Mothership %s lost track of us; registering again' % self.mothership )
+                previous = self.registry
+                if not self.register(free):
+                    logger.error( 'Mothership %s has blacklisted this host' % self.mothership )
+                    self.stopped = True
+                elif self.registry != previous:
+                    self.tasks_lock.acquire()
+                    self.orphans.update(busy & set(self.tasks))
+                    finished = len(busy - set(self.tasks))  # Since we counted
+                    self.tasks_lock.release()
+                    if finished:
+                        self.register(finished)
+            except Exception, detail:
+                logger.warning( 'Could not send heartbeat to %s: %r' % (self.mothership, detail) )
+
+    def offer_slot(self):
+        """
+        Register the slot of an orphaned task that has just finished
+        """
+        try:
+            self.register(1)
+        except Exception, detail:
+            logger.warning( 'Could not offer a slot to %s: %r' % (self.mothership, detail) )
+
+    def kill_stalled_tasks(self):
+        """
+        Kill the child of every token that has read no input and written no
+        output for TaskTimeout seconds. Its call then fails, so the
+        Mothership hands the token to someone else.
+        """
+        now = time.time()
+        self.tasks_lock.acquire()
+        try:
+            stalled = [task for task in self.tasks.values()
+                    if task.process and now - task.active.value > TaskTimeout]
+        finally:
+            self.tasks_lock.release()
+        for task in stalled:
+            logger.warning( 'Killing %r; it has stalled for %ds' % ((task.kind, task.token), now - task.active.value) )
+            task.process.terminate()
+
+    def register_rpcs(self, rpcserver):
+        rpcserver.register('map',self.rpc_map)
+        rpcserver.register('sample',self.rpc_sample)
+        rpcserver.register('shuffle',self.rpc_shuffle)
+        rpcserver.register('terminate',self.rpc_terminate)
+        rpcserver.register('status',self.rpc_status)
+        rpcserver.register('cancel',self.rpc_cancel)
+        rpcserver.register('fetch',self.rpc_fetch)
+
     def terminate(self):
-        command = '%s %d DOWN' % (socket.gethostname(), self.Port)
-        logger.info(command)
-        sendto(command, (self.mothership,ClientRegistry.Port))
+        logger.info( '%s:%d shutting down' % (socket.gethostname(), self.Port) )
+        if self.local_shuffle_dir():
+            shutil.rmtree(self.local_shuffle_dir(), ignore_errors=True)
+        try:
+            get_rpc(self.mothership, ClientRegistry.Port).unregister(self.hostname, self.Port)
+        except socket.error:
+            logger.warning( 'Couldnt connect to mothership ' + self.mothership )
         sys.exit()
 
     def initialize(self, args):
         pass
 
+    def open_input(self, token, encoding='utf8'):
+        """
+        Open a map input for reading. Jobs should use this rather than opening
+        the file themselves so that we can report progress and be cancelled,
+        and so that tokens for a range of a bz2 file only see their own
+        records. Pass encoding=None to read bytes rather than unicode.
+        """
+        (path, block_range) = split_block_range(token)
+        self.input = InputReader(self.local_copy(path), self.report_progress,
+                block_range=block_range)
+        self.counter('ufo', 'map input bytes', self.input.size)
+        if encoding:
+            return codecs.getreader(encoding)(self.input)
+        return self.input
+
+    def local_copy(self, path):
+        """
+        Path of a copy of path on this host's local disk when LocalCacheDir is
+        set, otherwise path itself. Use it for side files read in initialize()
+        so repeated jobs don't fetch them from the file server again.
+        """
+        if self.cache:
+            return self.cache.local_copy(path)
+        return path
+
+    def side_table(self, path, types=()):
+        """
+        A read-only dict-like table of the tab separated side file path,
+        mapping the first field of each line to a tuple of the rest converted
+        with types. It is built once per host and memory mapped, so every
+        worker on the host shares one copy. See ufo.sidedata.
+        """
+        directory = SideDataDir or LocalCacheDir or tempfile.gettempdir()
+        return open_table(path, types, directory)
+
+    def aggregator(self):
+        """
+        An Aggregator for map() to add up values per key in, in place of a
+        defaultdict: it spills its partial sums to SpillDirectory beyond
+        AggregateBufferSize bytes, and iterating over it gives each key's
+        total in key order. Whatever it leaves on disk is removed when the
+        token ends. See ufo.aggregate.
+        """
+        aggregator = Aggregator(AggregateBufferSize, SpillDirectory, MergeFanIn,
+                lambda: self.counter('ufo', 'aggregate spills'))
+        self.aggregators.append(aggregator)
+        return aggregator
+
+    def close_aggregators(self):
+        for aggregator in self.aggregators:
+            aggregator.close()
+        self.aggregators = []
+
+    def local_shuffle_dir(self):
+        """
+        Where this client keeps its map outputs for reducers to fetch, or
+        None to write them to shared storage: when LocalShuffle is off, and
+        in local worker processes, which can't serve them
+        """
+        if not LocalShuffle or not self.rpcserver:
+            return None
+        directory = os.path.join(ShuffleDir or tempfile.gettempdir(),
+                'ufo-shuffle-%s-%d' % (self.hostname, self.Port))
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass  # Another child got there first
+        return directory
+
+    def cached_inputs(self):
+        if self.cache:
+            return self.cache.cached_paths()
+        return []
+
+    def report_progress(self):
+        """
+        Called before every read of the map input and on every line of output
+        """
+        if self.task and self.input:
+            self.task.progress.value = self.input.progress()
+        self.check_cancelled()
+
+    def check_cancelled(self):
+        """
+        Called on every record read or written; also keeps the token from
+        counting as stalled
+        """
+        if self.task:
+            self.task.active.value = time.time()
+            if self.task.cancelled.value:
+                raise TaskCancelled()
+
+    def run_in_child(self, kind, token, method, args):
+        """
+        Run method(*args) for token in a forked child process and return what
+        it returns. The child starts with a copy-on-write copy of whatever
+        initialize() loaded, so up to Slots tokens can run side by side while
+        this process stays free to answer calls.
+        """
+        task = ChildTask(kind, token)
+        (receiver, sender) = multiprocessing.Pipe(False)
+        task.process = multiprocessing.Process(target=self.child_main,
+                args=(task, method, args, sender))
+        task.process.daemon = True  # Don't outlive the client
+
+        self.tasks_lock.acquire()
+        self.tasks[(kind, token)] = task
+        self.tasks_lock.release()
+
+        try:
+            task.process.start()
+            sender.close()
+            try:
+                (ok, result) = receiver.recv()
+            except EOFError:
+                (ok, result) = (False, 'child died running %r' % ((kind, token),))
+            receiver.close()
+            task.process.join()
+        finally:
+            self.tasks_lock.acquire()
+            del self.tasks[(kind, token)]
+            orphaned = (kind, token) in self.orphans
+            self.orphans.discard((kind, token))
+            self.tasks_lock.release()
+            if orphaned:
+                self.offer_slot()
+
+        if not ok:
+            raise RuntimeError(result)
+        return result
+
+    def child_main(self, task, method, args, sender):
+        """
+        Body of the child process running a single token
+        """
+        if self.rpcserver:
+            self.rpcserver.socket.close()  # Only the client takes calls
+        self.task = task
+        try:
+            result = (True, method(*args))
+        except Exception, detail:
+            logger.error( 'Token %r failed: %r' % ((task.kind, task.token), detail) )
+            result = (False, traceback.format_exc())
+        sender.send(result)
+        sender.close()
+
+    def discard_output(self):
+        """
+        Throw away everything written for a cancelled token
+        """
+        if self.sorter:
+            self.sorter.close()
+        for writer in self.writers:
+            writer.close()
+        for f in self.output_files:
+            if os.path.exists(f):
+                os.remove(f)
+
+    def output_codec(self, codec=None):
+        """
+        The codec to write this token's output with: the one the Mothership
+        asked for if it did, otherwise IntermediateCodec
+        """
+        return get_codec(codec or self.IntermediateCodec)
+
+    def open_output(self, output_files, combine=False, codec=None, final=False):
+        """
+        Start collecting output destined for output_files, one file per
+        partition. final output is always written as text.
+        """
+        self.output_files = output_files
+        self.output_format = get_format('text') if final else self.format
+        codec = self.output_codec(codec)
+        self.writers = [codec.writer(f) for f in output_files]
+
+        combiner = None
+        if combine and self.combine:
+            combiner = lambda records: combine_records(records, self.key, self.combine,
+                    self.format, self.KeyFields)
+        self.sorter = ExternalSorter(SortBufferSize, SpillDirectory, MergeFanIn, combiner,
+                self.format)
+
+    def close_output(self):
+        """
+        Merge the sorted runs and the remaining buffer into the output files
+        """
+        # Hand the writers large blocks; writing record by record spends more
+        # time in GzipFile.write than in compressing
+        encode = self.output_format.encode
+        pending = [[] for writer in self.writers]
+        records = 0
+        for (partition, record) in self.sorter:
+            pending[partition].append(encode(record))
+            records += 1
+            if len(pending[partition]) >= WriteBatch:
+                self.writers[partition].write(''.join(pending[partition]))
+                pending[partition] = []
+        for (writer, data) in zip(self.writers, pending):
+            writer.write(''.join(data))
+        self.sorter.close()
+        for writer in self.writers:
+            writer.close()
+
+        self.counter('ufo', '%s output records' % self.phase, records)
+        self.counter('ufo', '%s output bytes' % self.phase,
+                sum([os.path.getsize(f) for f in self.output_files]))
+
     def output(self, string):
         """
-        Add string to our output buffer, using a heap to maintain
-        invariance
+        Add string to our output buffer; it is written out in sorted order to
+        the file for its partition once the token is done. Jobs using binary
+        records get a record of its tab separated fields, all strings.
         """
-        # self.writer.write(u'%s\n' % unicode(string, 'utf8'))
-        self.writer.write('%s\n' % string)
+        if not isinstance(string, unicode):
+            string = string.decode('utf8')
+        self.add_record(self.format.from_line(string))
 
-        # This has to be in here b/c we don't have access to the output data
-        # anywhere else
-        if string[0:2].encode('ascii','replace').isalpha():
-            self.shuffle_keys.add(string[0:2])
+    def emit(self, key, *values):
+        """
+        Output a record of key followed by values, which may be ints, floats
+        or strings. A tuple key is several key fields. Text jobs get a line of
+        the fields separated by tabs.
+        """
+        if isinstance(key, tuple):
+            fields = key + values
+        else:
+            fields = (key,) + values
+        self.add_record(self.format.from_fields(fields))
 
-    def shuffle_reduce(self, token, base_path, shards):
-        logger.info('Processing shuffle shard [%s] over %d mapper shards' % (token, len(shards)))
+    def add_record(self, record):
+        self.report_progress()
 
-        # The basic idea here is to open each shard, find things that start with token and output them 
-        shuffle(shards)  # randomize access order
-        data = []
-        for shard_no, shard in enumerate(shards):
-            sys.stderr.write('%d / %d\n' % (shard_no, len(shards)))
-            for line in codecs.getreader('utf8')(BZ2File(shard)): 
-                if len(line) >= 2:
-                    for t in token: 
-                        if line.startswith(t):
-                            heappush(data, line.strip())
-                            # logger.info('on line [%s]' % line.encode('utf8'))
+        if len(self.writers) > 1:
+            self.sorter.add(record, self.partition(self.key(record), len(self.writers)))
+        else:
+            self.sorter.add(record)
 
-        output_file = '%s/REDUCE-%s-%s-%d-results.txt.bz2' % (base_path,
-                hash(tuple(token)), self.hostname,self.Port)
+    def counter(self, group, name, delta=1):
+        """
+        Add delta to the job counter name in group. Each token's counters are
+        sent back with its result; the Mothership adds up those of the
+        attempts it accepts and reports the totals at the end of the task.
+        """
+        counters = self.counters.setdefault(group, {})
+        counters[name] = counters.get(name, 0) + delta
 
-        self.writer = codecs.getwriter('utf8')(BZ2File(output_file, 'w'))
-        self.reduce(data)
-        self.writer.close()
+    def result(self, token, value):
+        """
+        What a successful token sends back to the Mothership
+        """
+        return {str(token):value, 'COUNTERS':self.counters}
+
+    def key(self, line):
+        """
+        The part of an output line that decides its partition. Lines with the
+        same key always end up in the same reduce partition. For binary
+        records it is the first field, or a tuple of the first KeyFields.
+        """
+        return self.format.key(line, self.KeyFields)
+
+    def partition(self, key, partitions):
+        """
+        Default partitioner: by range when the Mothership has sent boundaries
+        (see ufo.sampling), otherwise by hash. Override this to partition
+        differently; it must return the same value for key on every host.
+        """
+        if self.boundaries is not None:
+            return bisect_left(self.boundaries, key)
+        return (zlib.crc32(self.format.key_bytes(key)) & 0xffffffff) % partitions
+
+    def read_shard(self, shard, partition):
+        """
+        Lazily yield the records of a sorted map shard
+        """
+        records = 0
+        for record in self.format.read(InputReader(shard, self.check_cancelled)):
+            self.check_cancelled()
+            records += 1
+            yield (partition, record)
+        self.counter('ufo', 'reduce input records', records)
+        self.counter('ufo', 'reduce input bytes', os.path.getsize(shard))
+
+    def shuffle_reduce(self, partition, base_path, shards, codec=None, complete=True):
+        """
+        Merge this partition of every map output and reduce it. Unless the
+        map phase was complete when we started, shards is empty and the map
+        outputs are collected as they come, see collect_shards.
+        """
+        if complete:
+            logger.info('Processing shuffle partition [%d] over %d mapper shards' % (partition, len(shards)))
+        else:
+            logger.info('Processing shuffle partition [%d] as map shards come in' % partition)
+
+        # Copy the map shards kept on other clients' disks over here first
+        fetched = tempfile.mkdtemp(prefix='fetch-%05d-' % partition,
+                dir=self.local_shuffle_dir() or SpillDirectory)
+        try:
+            runs = []
+            if complete:
+                shards = self.fetch_shards(shards, fetched)
+            else:
+                (runs, shards) = self.collect_shards(partition, base_path, fetched)
+
+            # Each map shard is already sorted, so stream a k-way merge of them
+            # (and of any runs merged from them already) straight into the
+            # reducer
+            merged = merge_runs([read_run(run, True, self.format) for run in runs] +
+                    [self.read_shard(shard, partition) for shard in shards],
+                    MergeFanIn, SpillDirectory, self.format)
+            if self.combine and self.ReduceWithCombiner:
+                merged = combine_records(merged, self.key, self.combine, self.format,
+                        self.KeyFields)
+            data = (line for (_, line) in merged)
+
+            output_file = '%s/REDUCE-%05d-%s-%d-results.txt%s' % (base_path,
+                    partition, self.hostname,self.Port, self.output_codec(codec).Extension)
+
+            self.open_output([output_file], codec=codec, final=True)
+            self.reduce(data)
+            self.close_output()
+        finally:
+            shutil.rmtree(fetched, ignore_errors=True)
 
         return output_file
 
-    def reduce(self, data_heap):
+    def fetch_shards(self, urls, directory):
         """
-        This is the generic passthru reducer
+        Local paths of the map outputs urls, fetching those on other hosts
+        into directory
         """
-        while data_heap:
-            self.output(heappop(data_heap))
+        paths = fetch_shards(urls, directory, self.hostname, FetchThreads)
+        self.counter('ufo', 'reduce fetched bytes', sum([os.path.getsize(path)
+            for path in paths if os.path.dirname(path) == directory]))
+        return paths
+
+    def collect_shards(self, partition, base_path, directory):
+        """
+        Fetch this partition of each map token's output as the Mothership
+        reports it done, until they all are. Whenever MergeFanIn fetched
+        files pile up they are merged into one run, so little is left to
+        merge once the last map is in. Returns those runs and the map
+        outputs not merged yet.
+        """
+        # Our own connections, since we're a child of the client
+        registry = RpcProxy(ConnectionPool(), (self.mothership, ClientRegistry.Port))
+        have = set()  # Map tokens whose output we have; a map run twice
+                      # has a new output with the same records
+        runs = []
+        shards = []
+        while True:
+            (outputs, complete) = registry.map_outputs(base_path, partition)
+            new = [(token, url) for (token, url) in outputs.items() if token not in have]
+            if new:
+                shards.extend(self.fetch_shards([url for (_, url) in new], directory))
+                have.update([token for (token, _) in new])
+            while len(shards) >= MergeFanIn:
+                runs.append(self.premerge(shards[:MergeFanIn], partition, directory))
+                shards = shards[MergeFanIn:]
+            if complete:
+                logger.info('Shuffle partition [%d] has all %d mapper shards' % (partition, len(have)))
+                return (runs, shards)
+            self.check_cancelled()
+            time.sleep(MapOutputPoll)
+
+    def premerge(self, shards, partition, directory):
+        """
+        Merge map outputs into one run in directory, removing the ones we
+        fetched
+        """
+        records = merge(*[self.read_shard(shard, partition) for shard in shards])
+        if self.combine and self.ReduceWithCombiner:
+            records = combine_records(records, self.key, self.combine, self.format,
+                    self.KeyFields)
+        run = write_run(records, directory, self.format)
+        for shard in shards:
+            if os.path.dirname(shard) == directory:
+                os.remove(shard)
+        return run
+
+    def reduce(self, data):
+        """
+        This is the generic passthru reducer, unless the job has a
+        reduce_group. data is a sorted iterator over the lines (or binary
+        records) of this shuffle shard.
+        """
+        if self.reduce_group:
+            for (key, values) in self.groups(data):
+                self.reduce_group(key, values)
+            return
+        for line in data:
+            self.add_record(line)
+
+    def groups(self, data):
+        """
+        Split sorted data into (key, values) pairs, one per run of lines with
+        the same key. Only one line is held at a time; values a reducer
+        doesn't read are skipped when it moves on to the next key.
+        """
+        value = self.format.value
+        for (key, lines) in groupby(data, self.key):
+            yield (key, (value(line, key, self.KeyFields) for line in lines))
 
 
-    def rpc_map( self, meta, token):
-        output_file = token+'-%s-%d-results.txt.bz2' % (self.hostname,self.Port)
-        self.writer = codecs.getwriter('utf8')(BZ2File(output_file, 'w'))
-        data = self.load_previous_result(token)
-        if not data:
-            logger.info('Couldnt load previous result')
+    def rpc_map( self, meta, token, partitions, codec=None, final=False, boundaries=None):
+        return self.run_in_child('map', token, self.run_map,
+                (token, partitions, codec, final, boundaries))
+
+    def run_map(self, token, partitions, codec=None, final=False, boundaries=None):
+        """
+        final is set when there is no shuffle, so that our output is the
+        job's output. boundaries are the keys splitting range partitions.
+        """
+        self.boundaries = boundaries
+        attempt = '%s-%s-%d' % (token, self.hostname, self.Port)
+        directory = not final and self.local_shuffle_dir()
+        if directory:
+            # Kept here until the reducers fetch them; inputs in different
+            # directories may have the same name
+            attempt = os.path.join(directory, '%08x-%s' % (zlib.crc32(token) & 0xffffffff,
+                os.path.basename(attempt)))
+        extension = (final and '.txt' or self.format.Extension) + self.output_codec(codec).Extension
+        output_files = ['%s-p%05d-results%s' % (attempt, p, extension) for p in range(partitions)]
+        self.counters = {}
+        self.phase = 'map'
+        self.open_output(output_files, combine=True, codec=codec, final=final)
+        try:
             data = self.map(token)
-        self.writer.close()
+            self.close_output()
+        except TaskCancelled:
+            logger.info('Token [%s] was cancelled' % token)
+            self.discard_output()
+            return {'FAILED':'cancelled'}
+        finally:
+            self.input = None
+            self.close_aggregators()
             
         # logger.info( 'Got results: %s' % str(data) )
+        if directory:
+            output_files = [shard_url(self.hostname, self.Port, f) for f in output_files]
         if data:
-            return {str(token):(output_file, list(self.shuffle_keys))}
+            return self.result(token, output_files)
         else:
             return {'FAILED':0}
 
-    def load_previous_result(self, token):
+    def rpc_sample(self, meta, token, size):
+        return self.run_in_child('sample', token, self.run_sample, (token, size))
+
+    def run_sample(self, token, size):
         """
-        Look through all the results files on disk and try to load them
+        Run map over token keeping just a random sample of size of the keys
+        it outputs, for picking range partition boundaries
         """
-        if LoadPreviousResults:
-            data = False
-            (path, file_stem) = os.path.split(token)
-            print path, file_stem
-
-            for candidate in [x for x in os.listdir(path) if x.startswith(file_stem) and
-                    x.find('result') >= 0]:
-                candidate_path = os.path.join(path, candidate)
-                logger.info('Trying to reload from candidate [%s]...' %
-                        candidate_path)
-                try:
-                    self.reader = codecs.getreader('utf8')(BZ2File(candidate_path, 'r'))
-
-                    for line in self.reader:
-                        self.output(line.strip())
-                except EOFError:
-                    logger.info('Fail')
-                    continue
-                # except:
-                #     logger.info('Really Fail')
-                #     continue
+        self.output_files = []
+        self.writers = []
+        self.sorter = KeySampler(size, self.key)
+        try:
+            self.map(token)
+        except TaskCancelled:
+            return {'FAILED':'cancelled'}
+        finally:
+            if self.input:
+                self.input.close()
+            self.input = None
+            self.close_aggregators()
+        return {str(token):self.sorter.keys}
 
-                logger.info('Loaded successfully from [%s]' % candidate_path)
-                return True
+    def rpc_shuffle(self, meta, token, base_path, shards, codec=None, complete=True):
+        return self.run_in_child('shuffle', token, self.run_shuffle,
+                (token, base_path, shards, codec, complete))
 
-        return False
+    def run_shuffle(self, token, base_path, shards, codec=None, complete=True):
+        """
+        complete is unset for a reducer started before the map phase is over
+        """
+        self.counters = {}
+        self.phase = 'reduce'
+        self.sorter = None  # Nothing to discard if we're cancelled before
+        self.writers = []   # any output
+        self.output_files = []
+        try:
+            output_file = self.shuffle_reduce(token, base_path, shards, codec, complete)
+        except TaskCancelled:
+            logger.info('Shuffle [%s] was cancelled' % token)
+            self.discard_output()
+            return {'FAILED':'cancelled'}
+            
+        # logger.info( 'Got results: %s' % str(data) )
+        return self.result(token, output_file)
 
+    def rpc_status(self, meta):
+        """
+        Report each token we are working on, how long we have been at it and
+        what fraction of its input we have read (-1 if we can't tell)
+        """
+        now = time.time()
+        self.tasks_lock.acquire()
+        try:
+            tasks = [{'token':[task.kind, task.token], 'elapsed':now - task.started,
+                'progress':task.progress.value} for task in self.tasks.values()]
+        finally:
+            self.tasks_lock.release()
+        return {'slots':self.Slots, 'tasks':tasks, 'cached':self.cached_inputs()}
 
+    def rpc_fetch(self, meta, path, offset, size):
+        """
+        Up to size bytes from offset of one of our map outputs, see ufo.fetch
+        """
+        if not self.local_shuffle_dir():
+            raise ValueError('%s:%d keeps no map outputs' % (self.hostname, self.Port))
+        return read_chunk(self.local_shuffle_dir(), path, offset, size)
 
-    def rpc_shuffle(self, meta, token, base_path, shards):
-        output_file = self.shuffle_reduce(token, base_path, shards)
-            
-        # logger.info( 'Got results: %s' % str(data) )
-        return {str(token):output_file}
+    def rpc_cancel(self, meta, token):
+        """
+        Abandon token if we are still working on it; someone else beat us. The
+        child notices the next time it reads input or writes output.
+        """
+        self.tasks_lock.acquire()
+        task = self.tasks.get(tuple(token))
+        self.tasks_lock.release()
+        if task:
+            logger.info('Cancelling %r' % (token,))
+            task.cancelled.value = 1
+            return True
+        return False
 
     def rpc_terminate(self, meta):
         self.stopped = True
         return self.stopped
 
+# The Mapper inside each local worker process
+local_mapper = None
+
+def init_local_worker(mapper_class, args):
+    global local_mapper
+    local_mapper = mapper_class(None, args)
+
+def call_local_worker(method, args):
+    # Pool processes can't fork children of their own, so run tokens inline.
+    # A pipeline's stage methods are named 'stage.method'.
+    (stage, _, method) = method.rpartition('.')
+    mapper = local_mapper
+    if stage:
+        mapper = local_mapper.stage_mapper(stage)
+    try:
+        return getattr(mapper, 'run_' + method)(*args)
+    except Exception:
+        # Exceptions lose their traceback on the way back through the pool
+        raise RuntimeError(traceback.format_exc())
+
+class LocalWorkers:
+    """
+    Stands in for remote clients when running on a single machine: tokens are
+    run by a pool of processes, each holding its own initialized Mapper, and
+    data moves through files on the local disk.
+    """
+    Host = 'local'
+
+    def __init__(self, mapper_class, args, processes):
+        self.processes = processes
+        self.pool = multiprocessing.Pool(processes, init_local_worker, (mapper_class, args))
+        self.prefix = ''  # Put in front of method names, like RpcProxy's
+
+    def for_stage(self, name):
+        """
+        The same pool, running the tokens of one stage of a pipeline
+        """
+        workers = copy.copy(self)
+        workers.prefix = name + '.'
+        return workers
+
+    def register(self):
+        """
+        Add one pseudo-server per process to the list of idle servers
+        """
+        live_servers_lock.acquire()
+        for i in range(self.processes):
+            live_servers.append((LocalWorkers.Host, i))
+            idle_servers.append((LocalWorkers.Host, i))
+        live_servers_lock.release()
+
+    def map(self, *args):
+        return self.pool.apply(call_local_worker, (self.prefix + 'map', args))
+
+    def sample(self, *args):
+        return self.pool.apply(call_local_worker, (self.prefix + 'sample', args))
+
+    def shuffle(self, *args):
+        return self.pool.apply(call_local_worker, (self.prefix + 'shuffle', args))
+
+    # The pool can't reach a process while it is busy, so local tokens can't
+    # report progress or be cancelled
+    def status(self):
+        return {'tasks':[]}
+
+    def cancel(self, token):
+        return False
+
+    def terminate(self):
+        return True
+
 class Mothership(threading.Thread):
     """
     Abstract base class for a Mothership. Supports an arbitrary number of
@@ -257,6 +1059,11 @@ class Mothership(threading.Thread):
     are consumed in this way, the generation is complete.
     """
 
+    # Range partition the map output on keys sampled before the map phase
+    # (see ufo.sampling) instead of hashing it, so that the final shards are
+    # in key order and together make up one sorted output
+    SortedOutput = False
+
     def __init__( self ):
         threading.Thread.__init__(self)
         
@@ -266,48 +1073,456 @@ class Mothership(threading.Thread):
 
         self.Tokens = {}
         self.Tokens_lock = threading.Lock()
-
-        # Start up a thread for the Client Registry
-        self.condor_server = ClientRegistry()
-        self.condor_server.daemon = True
-        self.condor_server.start()
+        self.ready = []  # Heap of (-weight, tie, token) waiting for a server,
+                         # largest first; may hold stale entries for tokens
+                         # that were consumed since
+        self.weights = {}  # token -> its weight, see token_weight
+        self.history = {}  # token -> (seconds, input bytes) of its last run
+        self.rates = {}  # Token kind -> seconds per input byte in the history
+        self.tokens_by_input = {}  # Input file -> the map tokens reading it
+
+        self.local_workers = None  # Set when running in --local mode
+        self.status_port = StatusPort  # Where to serve the status page, if anywhere
+        self.finished = False  # Set once every token of the task is done
+        self.failed = None  # Why the job failed, if a token ran out of attempts
+
+        self.journal = None
+        self.recovered = {}  # token -> result for tokens done before a restart
+        self.boundaries = None  # Keys splitting the range partitions, if any
+        self.sampling = False  # Are we running sample tokens before the map?
+        self.samples = []  # Keys they sent back
+        self.map_tokens = {}  # The map tokens, put aside while sampling
+        self.counters = {}  # group -> name -> total over the accepted tokens
 
         self.data_lock = threading.Lock()
 
         self.shuffled = False  # Have we run shuffle step
         self.skip_shuffle = False # should we skip the shuffle altogether and merge unsorted?
-        self.shuffle_keys = set()  # For now we key off of the first letter
-
-        self.map_result_shards = [] # Keep track of the output shard files that were successful
+        self.durations = {} # Token kind -> how long each completed token of that kind took
+        self.early_attempts = set()  # (token, server) of each reducer started
+                                     # before the map phase was over
+        self.preempted = set()  # Those of them we've cancelled to run maps
+        self.phase_total = 0  # Tokens in the current phase, including recovered ones
+        self.workers = {}  # (server, port) -> throughput totals, see record_throughput
+
+        self.map_result_shards = {} # Keep track of the output shard files that were successful:
+                                    # map token -> its list of partition files
+        self.token_counters = {}  # token -> the counters of its accepted attempt
         self.shuffle_result_shards = [] # Keep track of the output shard files that were successful
         
 
+    def start_registry(self):
+        """
+        Start up a thread for the Client Registry so remote clients can join
+        """
+        self.condor_server = ClientRegistry()
+        self.condor_server.daemon = True
+        self.condor_server.start()
+
+    def start_local_workers(self, mapper_class, args, processes):
+        """
+        Run tokens in a pool of processes on this machine instead
+        """
+        self.local_workers = LocalWorkers(mapper_class, args, processes)
+        self.local_workers.register()
+
+    def get_rpc(self, server, port):
+        if self.local_workers and server == LocalWorkers.Host:
+            return self.local_workers
+        return get_rpc(server, port)
+
     def handle_token_on_server(self, (server, port), token):
         """ A procedure for a thread waiting on an rpc call. Returns a function
         that uses the specified arguments."""
         try:
             if token[0] == 'map':
-                res = get_rpc(server, port).map(token[1])
+                # Without a shuffle the map outputs are the final shards
+                codec = None
+                if self.skip_shuffle:
+                    codec = self.result_codec()
+                res = self.get_rpc(server, port).map(token[1], self.get_partitions(), codec,
+                        self.skip_shuffle, self.boundaries)
+            elif token[0] == 'sample':
+                res = self.get_rpc(server, port).sample(token[1], SampleSize)
             elif token[0] == 'shuffle':
-                res = get_rpc(server, port).shuffle(token[1], self.base_path, self.map_result_shards)
+                # Each reducer only reads its own partition of every map output.
+                # One started early gets them from map_outputs as they come.
+                self.Tokens_lock.acquire()
+                try:
+                    complete = not self.maps_left()
+                    shards = []
+                    if complete:
+                        shards = [shards[token[1]] for shards in self.map_result_shards.values()]
+                    else:
+                        self.early_attempts.add((token, (server, port)))
+                finally:
+                    self.Tokens_lock.release()
+                res = self.get_rpc(server, port).shuffle(token[1], self.base_path, shards,
+                        self.result_codec(), complete)
             else:
                 raise 'Unknown token type'
         except Exception, detail:
-            logger.warning( 'Dropping server: %r %r' % (Exception, detail) )
+            lost_output = failed_fetch(detail)
+            # Unless the client itself is gone, in which case lose_server
+            # requeues this along with the rest of its tokens
+            gone = not lost_output and isinstance(detail, (socket.error, EOFError)) and \
+                    server != LocalWorkers.Host
+            self.Tokens_lock.acquire()
+            try:
+                state = self.Tokens.get(token)
+                started = state and state.started.get((server,port))
+                # A reducer we cancelled to make room for maps didn't fail
+                preempted = (token, (server,port)) in self.preempted
+                if started and not gone and not lost_output and not preempted:
+                    # Held against the host only if the token then succeeds
+                    # elsewhere, see handle_token_on_server
+                    state.failures.append((server, port))
+                    if MaxTokenAttempts and len(state.failures) >= MaxTokenAttempts and not self.failed:
+                        self.failed = 'Token %r failed %d times, last on %s:%d: %s' % (token,
+                                len(state.failures), server, port, detail)
+                if not gone:
+                    self.end_attempt(token, (server,port))
+                if lost_output:
+                    self.rerun_map(lost_output)
+            finally:
+                self.Tokens_lock.release()
+            if lost_output:
+                # Not this server's fault
+                logger.warning( 'Token %r on %s:%d could not fetch %s' % (token, server, port, lost_output) )
+                self.free_slot((server, port))
+            elif gone:
+                if started:
+                    self.lose_server((server, port), 'connection failed running %r: %r' % (token, detail))
+                    self.record_failure((server, port))
+            else:
+                # The token failed (or was killed) but the client is still there
+                # Just the last line; the whole traceback is in the client's log
+                logger.warning( 'Token %r failed on %s:%d: %s' % (token, server, port,
+                        str(detail).strip().split('\n')[-1]) )
+                self.free_slot((server, port))
+            schedule_event.set()
             return 
         
         # Add the server back to idle immediately
+        self.free_slot((server, port))
+
+        # Lock the tokens so it can be processed 
+        blamed = []
+        self.Tokens_lock.acquire()
+        try:
+            state = self.Tokens.get(token)
+            # Time an early reducer spent waiting for maps says nothing about
+            # how long reducers take
+            early = (token, (server,port)) in self.early_attempts
+            started = self.end_attempt(token, (server,port))
+            counters = res.get('COUNTERS', {})
+            self.process_result( res, (server,port), token )
+            if started and not early and not res.has_key('FAILED'):
+                self.record_throughput((server,port), time.time() - started, counters)
+            if started and token not in self.Tokens:
+                # We won; stop any speculative copies still running
+                if not early:
+                    self.durations.setdefault(token[0], []).append(time.time() - started)
+                    ufo_counters = counters.get('ufo', {})
+                    self.history[token] = (time.time() - started,
+                            ufo_counters.get('map input bytes', 0) + ufo_counters.get('reduce input bytes', 0))
+                for other in state.started.keys():
+                    self.cancel_token_on(other, token)
+                # The token itself is fine, so its earlier failures were the
+                # fault of the hosts they happened on
+                blamed = set([failure for failure in state.failures if failure[0] != server])
+        finally:
+            self.Tokens_lock.release()
+        for live_server in blamed:
+            self.record_failure(live_server)
+        schedule_event.set()
+
+    def end_attempt(self, token, live_server):
+        """
+        Forget about an attempt at token that has finished one way or another,
+        returning when it started. Precondition: we're inside the token lock.
+        """
+        self.early_attempts.discard((token, live_server))
+        self.preempted.discard((token, live_server))
+        state = self.Tokens.get(token)
+        if not state:
+            return None
+        started = state.started.pop(live_server, None)
+        state.progress.pop(live_server, None)
+        state.read_all.pop(live_server, None)
+        if not state.started and state.farmed:
+            # Nobody else is on it, so put it back in line
+            state.farmed = False
+            self.push_ready(token)
+        return started
+
+    def free_slot(self, live_server):
+        """
+        Put a slot of live_server back on the idle list, unless we've given
+        up on that server in the meantime
+        """
         live_servers_lock.acquire()
         try:
-            idle_servers.append( (server,port) )
+            if live_server in live_servers:
+                idle_servers.append(live_server)
         finally:
             live_servers_lock.release()
 
-        # Lock the tokens so it can be processed 
+    def lose_server(self, live_server, reason):
+        """
+        Stop using live_server and hand the tokens it was running to someone
+        else. Its calls still in flight are ignored unless they return a
+        result nobody else has yet.
+        """
+        (server, port) = live_server
         self.Tokens_lock.acquire()
+        live_servers_lock.acquire()
         try:
-            self.process_result( res, (server,port), token )
+            if live_server in live_servers:
+                live_servers.remove(live_server)
+            while live_server in idle_servers:
+                idle_servers.remove(live_server)
+            last_heartbeat.pop(live_server, None)
+            lost = [token for (token, state) in self.Tokens.items() if live_server in state.started]
+            for token in lost:
+                self.end_attempt(token, live_server)
+        finally:
+            live_servers_lock.release()
+            self.Tokens_lock.release()
+        connection_pool.discard(live_server)
+        logger.warning( 'Lost server %s:%d (%s); requeued %d tokens' % (server, port, reason, len(lost)) )
+        schedule_event.set()
+
+    def record_failure(self, (server, port)):
+        """
+        Count a failure against server's host, blacklisting the host once it
+        has had MaxHostFailures of them. Local workers are never blacklisted.
+        """
+        if server == LocalWorkers.Host:
+            return
+        live_servers_lock.acquire()
+        try:
+            host_failures[server] = host_failures.get(server, 0) + 1
+            blacklist = MaxHostFailures and host_failures[server] >= MaxHostFailures and \
+                    server not in blacklisted_hosts
+            if blacklist:
+                blacklisted_hosts.add(server)
+            doomed = [live_server for live_server in live_servers if live_server[0] == server]
         finally:
+            live_servers_lock.release()
+        if blacklist:
+            logger.error( 'Blacklisting host %s after %d failures' % (server, host_failures[server]) )
+            for live_server in doomed:
+                self.lose_server(live_server, 'host blacklisted')
+
+    def watch_heartbeats(self):
+        """
+        Give up on clients we haven't heard from for HeartbeatTimeout seconds
+        """
+        while not self.finished:
+            time.sleep(HeartbeatRate)
+            now = time.time()
+            live_servers_lock.acquire()
+            silent = [live_server for live_server in live_servers
+                    if now - last_heartbeat.get(live_server, now) > HeartbeatTimeout]
+            live_servers_lock.release()
+            for live_server in silent:
+                self.lose_server(live_server, 'no heartbeat for %ds' % HeartbeatTimeout)
+                self.record_failure(live_server)
+
+    def cancel_token_on(self, (server, port), token):
+        """
+        Tell a server to give up on a token that was completed elsewhere
+        """
+        def cancel():
+            try:
+                self.get_rpc(server, port).cancel(token)
+            except Exception, detail:
+                logger.warning( 'Could not cancel %r on %s:%d: %r' % (token, server, port, detail) )
+        p = threading.Thread(target=cancel)
+        p.daemon = True
+        p.start()
+
+    def poll_progress(self):
+        """
+        Periodically ask every server running a token how far along it is
+        """
+        while not self.finished:
+            time.sleep(ProgressRate)
+
+            self.Tokens_lock.acquire()
+            attempts = [(token, live_server) for (token, state) in self.Tokens.items()
+                    for live_server in state.started.keys()]
+            self.Tokens_lock.release()
+
+            for (token, (server, port)) in attempts:
+                try:
+                    status = self.get_rpc(server, port).status()
+                except Exception:
+                    continue
+                if 'cached' in status:
+                    live_servers_lock.acquire()
+                    host_caches[server] = set(status['cached'])
+                    live_servers_lock.release()
+                self.Tokens_lock.acquire()
+                state = self.Tokens.get(token)
+                for task in status.get('tasks', []):
+                    if state and task['token'] == list(token) and task['progress'] >= 0:
+                        state.progress[(server, port)] = task['progress']
+                        if task['progress'] >= 1.0:
+                            state.read_all.setdefault((server, port), time.time())
+                self.Tokens_lock.release()
+
+            # New estimates may make some token worth duplicating
+            schedule_event.set()
+
+    def mean_duration(self, kind=None):
+        """
+        How long completed tokens of kind took on average (any kind if None),
+        or None before any have
+        """
+        if kind is None:
+            durations = [d for ds in self.durations.values() for d in ds]
+        else:
+            durations = self.durations.get(kind, [])
+        if not durations:
+            return None
+        return sum(durations) / len(durations)
+
+    def estimate_completion(self, token, state, now):
+        """
+        When we expect the earliest running attempt at a token to finish,
+        going by its reported progress or else by how long completed tokens
+        of its kind took
+        """
+        expected = self.mean_duration(token[0])
+
+        estimates = []
+        for (live_server, started) in state.started.items():
+            elapsed = now - started
+            progress = state.progress.get(live_server, 0)
+            if live_server in state.read_all:
+                # It has read all its input but is still at work (writing
+                # out sums, merging); assume what's left takes as long again
+                # as it has so far
+                tail = now - state.read_all[live_server]
+                estimates.append(max(now + tail, started + (expected or 0)))
+            elif progress > 0:
+                estimates.append(started + elapsed / progress)
+            elif expected:
+                estimates.append(started + max(expected, elapsed))
+            else:
+                estimates.append(started + 2 * elapsed)  # Assume it's half done
+        return min(estimates)
+
+    def pick_speculative_token(self, live_server):
+        """
+        Choose a running token worth duplicating on live_server: the one whose
+        estimated completion is latest, if a fresh copy could beat it.
+        Precondition: we're inside the token lock.
+        """
+        now = time.time()
+        best, best_finish = None, None
+        maps_left = self.maps_left()
+        for (token, state) in self.Tokens.items():
+            if token[0] == 'shuffle' and maps_left:
+                continue  # Early reducers are slow because they wait for maps
+            if live_server[0] in [failure[0] for failure in state.failures]:
+                continue  # It has already failed on this host
+            if state.started and len(state.started) < SpeculativeCopies and \
+                    live_server not in state.started:
+                finish = self.estimate_completion(token, state, now)
+                if best is None or finish > best_finish:
+                    best, best_finish = token, finish
+
+        if best:
+            expected = self.mean_duration(best[0])
+            if expected is not None and best_finish <= now + expected:
+                return None
+        return best
+
+    def record_throughput(self, live_server, elapsed, counters):
+        """
+        Add a finished attempt to live_server's totals. Precondition: we're
+        inside the token lock.
+        """
+        stats = self.workers.setdefault(live_server,
+                {'tokens':0, 'seconds':0.0, 'bytes':0, 'documents':0})
+        stats['tokens'] += 1
+        stats['seconds'] += elapsed
+        ufo_counters = counters.get('ufo', {})
+        stats['bytes'] += ufo_counters.get('map input bytes', 0) + \
+                ufo_counters.get('reduce input bytes', 0)
+        stats['documents'] += counters.get('documents', {}).get('read', 0)
+
+    def estimate_remaining(self, now, slots):
+        """
+        Seconds until the current phase is done if slots tokens run at once,
+        going by how long completed tokens took, or None before any have.
+        Precondition: we're inside the token lock.
+        """
+        if not self.durations:
+            return None
+        work = 0.0
+        for (token, state) in self.Tokens.items():
+            if state.started:
+                work += max(self.estimate_completion(token, state, now) - now, 0)
+            else:
+                work += self.mean_duration(token[0]) or self.mean_duration()
+        return work / max(slots, 1)
+
+    def status(self):
+        """
+        A snapshot of the job for the status page
+        """
+        now = time.time()
+        self.Tokens_lock.acquire()
+        live_servers_lock.acquire()
+        try:
+            running = []
+            for (token, state) in self.Tokens.items():
+                for (live_server, started) in state.started.items():
+                    running.append({'token':token, 'server':'%s:%d' % live_server,
+                            'elapsed':now - started,
+                            'progress':state.progress.get(live_server)})
+            running.sort(key=lambda attempt: -attempt['elapsed'])
+
+            workers = {}
+            for live_server in live_servers:
+                stats = dict(self.workers.get(live_server,
+                        {'tokens':0, 'seconds':0.0, 'bytes':0, 'documents':0}))
+                seconds = stats['seconds'] or None
+                stats['docs_per_second'] = seconds and stats['documents'] / seconds
+                stats['mb_per_second'] = seconds and stats['bytes'] / seconds / 1e6
+                stats['idle_slots'] = idle_servers.count(live_server)
+                stats['host_failures'] = host_failures.get(live_server[0], 0)
+                if live_server in last_heartbeat:
+                    stats['heartbeat_age'] = now - last_heartbeat[live_server]
+                stats['running'] = [attempt['token'] for attempt in running
+                        if attempt['server'] == '%s:%d' % live_server]
+                workers['%s:%d' % live_server] = stats
+
+            slots = len(idle_servers) + len(running)
+            phase = (self.sampling and 'sample') or (self.shuffled and self.maps_left() and 'map+shuffle') or \
+                    (self.shuffled and 'shuffle') or 'map'
+            remaining = self.estimate_remaining(now, slots)
+            pending = len([state for state in self.Tokens.values() if not state.started])
+            return {
+                'phase': phase,
+                'tokens': {'total':self.phase_total, 'pending':pending,
+                           'running':len(self.Tokens) - pending,
+                           'done':self.phase_total - len(self.Tokens)},
+                'running': running,
+                'slowest': running[:StatusSlowest],
+                'mean_token_seconds': self.mean_duration(phase.split('+')[-1]),
+                'eta_seconds': remaining,
+                'eta': remaining is not None and time.ctime(now + remaining) or None,
+                'workers': workers,
+                'blacklisted': sorted(blacklisted_hosts),
+                'counters': self.counters,
+            }
+        finally:
+            live_servers_lock.release()
             self.Tokens_lock.release()
 
     def initialize(self, args):
@@ -320,29 +1535,431 @@ class Mothership(threading.Thread):
 
         self.initialize(base_path, shards)
         self.Tokens = self.get_map_tokens()
+        self.phase_total = len(self.Tokens)
+        self.load_history()
+        self.open_journal()
+        if self.range_partitioned() and self.boundaries is None:
+            self.start_sampling()
+        else:
+            self.recover_tokens()
+        self.queue_tokens()
 
         self.Tokens_lock.release()
 
+    def range_partitioned(self):
+        return self.SortedOutput and not self.skip_shuffle
+
+    def start_sampling(self):
+        """
+        Put the map tokens aside and first run a few of them to pick range
+        partition boundaries from samples of their keys. Precondition:
+        we're inside the token lock.
+        """
+        self.map_tokens = self.Tokens
+        self.Tokens = dict([(('sample', token), Token()) for (_, token) in
+                sample(self.map_tokens.keys(), min(SampleTokens, len(self.map_tokens)))])
+        self.phase_total = len(self.Tokens)
+        self.sampling = True
+        logger.info('Sampling keys from %d map tokens...' % len(self.Tokens))
+
+    def finish_sampling(self):
+        """
+        Pick the boundaries and go on to the map tokens. Precondition: we're
+        inside the token lock.
+        """
+        self.boundaries = pick_boundaries(self.samples, self.get_partitions())
+        logger.info('Picked %d partition boundaries from %d sampled keys' %
+                (len(self.boundaries), len(self.samples)))
+        self.samples = []
+        if self.journal:
+            # Keys may be unicode or tuples, which json would turn into
+            # something else
+            self.journal.write({'boundaries':cPickle.dumps(self.boundaries, 2).encode('base64')})
+
+        self.sampling = False
+        self.Tokens = self.map_tokens
+        self.phase_total = len(self.Tokens)
+        self.recover_tokens()
+        self.queue_tokens()
+
+    def get_journal_file(self):
+        """
+        Where to journal completed tokens, or None to not bother
+        """
+        return None
+
+    def open_journal(self):
+        """
+        Replay the journal left by an earlier run of this task if there is
+        one, otherwise start a new one. Precondition: we're inside the token
+        lock.
+        """
+        path = self.get_journal_file()
+        if not path:
+            return
+        self.journal = Journal(path)
+
+        header = {'job':os.path.basename(sys.argv[0]), 'base_path':self.base_path,
+                'partitions':self.get_partitions(), 'skip_shuffle':self.skip_shuffle,
+                'sorted':self.range_partitioned()}
+        (previous, entries) = self.journal.replay()
+        if previous and all(previous.get(k) == v for (k, v) in header.items()):
+            # Pick up where we left off, with the same (possibly sampled) map
+            # tokens as before
+            self.Tokens = dict([(tuple(token), Token()) for token in previous['map_tokens']])
+            # Map outputs kept on clients are still there if the clients are
+            pool = ConnectionPool()
+            unreachable = set()
+            for entry in entries:
+                if 'boundaries' in entry:
+                    self.boundaries = cPickle.loads(entry['boundaries'].decode('base64'))
+                    continue
+                token = tuple(entry['token'])
+                result = entry['result']
+                files = result if isinstance(result, list) else [result]
+                if all(shard_exists(pool, f, unreachable) for f in files):
+                    # A map run again after its outputs were lost is in here
+                    # twice; only the last run counts
+                    self.add_counters(self.token_counters.get(token, {}), -1)
+                    self.recovered[token] = result
+                    self.token_counters[token] = entry.get('counters', {})
+                    self.add_counters(self.token_counters[token])
+                else:
+                    logger.warning('Output of %r has gone missing; rerunning it' % (token,))
+            for (host, port) in unreachable:
+                logger.warning('Map outputs kept on %s:%d are lost with it' % (host, port))
+            self.journal.resume()
+            logger.info('Resuming from journal [%s] with %d tokens done' % (path, len(self.recovered)))
+        else:
+            if previous:
+                logger.warning('Journal [%s] is for a different task; starting over' % path)
+            header['map_tokens'] = sorted(self.Tokens.keys())
+            self.journal.start(header)
+
+    def queue_tokens(self):
+        """
+        Line up every token of a new phase, largest first. Precondition:
+        we're inside the token lock.
+        """
+        self.ready = []
+        for token in self.Tokens:
+            self.push_ready(token)
+
+        self.tokens_by_input = {}
+        for (_, _, token) in sorted(self.ready):
+            if token[0] == 'map':
+                self.tokens_by_input.setdefault(split_block_range(token[1])[0], []).append(token)
+
+    def push_ready(self, token):
+        """
+        Put token in line. Bigger tokens go first so the small ones fill in
+        at the end of the phase rather than a big one holding it up; equal
+        ones go in random order. Precondition: we're inside the token lock.
+        """
+        weight = self.weights.get(token)
+        if weight is None:
+            weight = self.weights[token] = self.token_weight(token)
+        heappush(self.ready, (-weight, random(), token))
+
+    def token_weight(self, token):
+        """
+        How long we expect token to take: the seconds it took when this job
+        last ran it, if it did, otherwise its input bytes at the seconds per
+        byte of the history, or just its input bytes without one. Only the
+        order matters.
+        """
+        if token in self.history:
+            return self.history[token][0]
+        size = self.token_size(token)
+        return size * self.rates.get(token[0], 1.0)
+
+    def token_size(self, token):
+        """
+        Bytes of input token reads, as far as we can tell here: the shard or
+        block range of a map token, and the map outputs of a shuffle token
+        that are on shared storage. 0 when we can't tell.
+        """
+        if token[0] == 'map':
+            (path, block_range) = split_block_range(token[1])
+            if block_range:
+                return (block_range[1] - block_range[0]) // 8  # Bit offsets
+            paths = [path]
+        elif token[0] == 'shuffle':
+            paths = [shards[token[1]] for shards in self.map_result_shards.values()
+                    if not parse_url(shards[token[1]])]
+        else:
+            return 0
+        return sum([os.path.getsize(path) for path in paths if os.path.exists(path)])
+
+    def next_ready_token(self, server=None):
+        """
+        Pop the next token nobody is working on, or None. Shuffle tokens wait
+        while any map token is waiting for a slot, and until every map is done
+        if reducers can't start early. A token that has failed on server's
+        host is left for a host it hasn't failed on, if one is up.
+        Precondition: we're inside the live_servers_lock and token lock.
+        """
+        held = []
+        hold = None
+        hosts = set([live_server[0] for live_server in live_servers])
+        try:
+            while self.ready:
+                (_, _, token) = heappop(self.ready)
+                state = self.Tokens.get(token)
+                if state and not state.farmed:
+                    failed_on = set([failure[0] for failure in state.failures])
+                    if server in failed_on and hosts - failed_on:
+                        held.append(token)
+                        continue
+                    if token[0] == 'shuffle':
+                        if hold is None:
+                            hold = self.hold_shuffles()
+                        if hold:
+                            held.append(token)
+                            continue
+                    return token
+            return None
+        finally:
+            for token in held:
+                self.push_ready(token)
+
+    def maps_left(self):
+        """
+        Are any map tokens not done yet? Precondition: we're inside the token
+        lock.
+        """
+        for token in self.Tokens:
+            if token[0] == 'map':
+                return True
+        return False
+
+    def maps_waiting(self):
+        """
+        Are any map tokens waiting for a slot? Precondition: we're inside the
+        token lock.
+        """
+        for (token, state) in self.Tokens.items():
+            if token[0] == 'map' and not state.farmed:
+                return True
+        return False
+
+    def hold_shuffles(self):
+        """
+        Should shuffle tokens wait for now? Local workers can't ask for map
+        outputs as they come, so they always wait for the maps to be done.
+        Precondition: we're inside the token lock.
+        """
+        if self.local_workers or SlowStartFraction is None:
+            return self.maps_left()
+        return self.maps_waiting()
+
+    def slow_start_due(self):
+        """
+        Is it time to start the reducers, with some map tokens still to go?
+        Precondition: we're inside the token lock.
+        """
+        if self.shuffled or self.sampling or self.skip_shuffle or self.local_workers or \
+                SlowStartFraction is None:
+            return False
+        done = self.phase_total - len(self.Tokens)
+        return done >= SlowStartFraction * self.phase_total
+
+    def start_shuffle(self):
+        """
+        Queue the shuffle tokens; they wait for whatever map tokens are left.
+        Precondition: we're inside the token lock.
+        """
+        maps = len(self.Tokens)
+        self.Tokens.update(self.get_shuffle_tokens())
+        self.phase_total = len(self.Tokens)
+        self.recover_tokens()
+        tokens = [token for token in self.Tokens if token[0] == 'shuffle']
+        for token in tokens:
+            self.push_ready(token)
+        self.shuffled = True
+        if maps:
+            logger.info('Starting on %d shuffle shards with %d map tokens left...' % (len(tokens), maps))
+        else:
+            logger.info('Starting on %d shuffle shards...' % len(tokens))
+
+    def map_outputs(self, base_path, partition):
+        """
+        For a reducer started before the map phase is over: the output for
+        partition of each map token done so far, by token, and whether they
+        all are
+        """
+        if base_path != self.base_path:
+            raise ValueError('Not running a task in %s' % base_path)
+        self.Tokens_lock.acquire()
+        try:
+            outputs = dict([(token, shards[partition]) for (token, shards) in
+                self.map_result_shards.items()])
+            return (outputs, not self.maps_left())
+        finally:
+            self.Tokens_lock.release()
+
+    def rerun_map(self, url):
+        """
+        Run the map token whose output url a reducer couldn't fetch again,
+        along with every other one whose outputs were on the same client.
+        Precondition: we're inside the token lock.
+        """
+        client = parse_url(url)[:2]
+        for (token, shards) in self.map_result_shards.items():
+            if [shard for shard in shards if (parse_url(shard) or ())[:2] == client]:
+                logger.warning('Map outputs on %s:%d are lost; running %r again' % (client + (token,)))
+                del self.map_result_shards[token]
+                # Its next run is counted instead
+                self.add_counters(self.token_counters.pop(token, {}), -1)
+                self.Tokens[token] = Token()
+                self.phase_total += 1
+                self.push_ready(token)
+
+    def next_local_token(self, (server, port)):
+        """
+        Pop a waiting token whose input is already cached on server, or None.
+        Precondition: we're inside the live_servers_lock and token lock.
+        """
+        for path in host_caches.get(server, ()):
+            for token in self.tokens_by_input.get(path, ()):
+                state = self.Tokens.get(token)
+                if state and not state.farmed:
+                    return token
+        return None
+
+    def recover_tokens(self):
+        """
+        Consume the tokens the journal says were already completed.
+        Precondition: we're inside the token lock.
+        """
+        for token in self.Tokens.keys():
+            if token in self.recovered:
+                if token[0] == 'map':
+                    self.map_result_shards[token] = self.recovered[token]
+                elif token[0] == 'shuffle':
+                    self.shuffle_result_shards.append(self.recovered[token])
+                del self.Tokens[token]
+
+    def add_counters(self, counters, sign=1):
+        """
+        Add counters to the job totals, or take them off with sign -1
+        """
+        for (group, names) in counters.items():
+            totals = self.counters.setdefault(group, {})
+            for (name, count) in names.items():
+                totals[name] = totals.get(name, 0) + sign * count
+
+    def report_counters(self):
+        """
+        Log the job counters and save them to get_counters_file() if there
+        is one
+        """
+        for group in sorted(self.counters):
+            logger.info('Counters [%s]' % group)
+            for (name, count) in sorted(self.counters[group].items()):
+                logger.info('    %-30s %d' % (name, count))
+        path = self.get_counters_file()
+        if path:
+            out = open(path, 'w')
+            json.dump(self.counters, out, indent=2, sort_keys=True)
+            out.close()
+
+    def get_counters_file(self):
+        """
+        Where to write the job counters at the end of the task, or None
+        """
+        return None
+
+    def get_history_file(self):
+        """
+        Where to keep how long each token took, for ordering the tokens of
+        the next run of the job, or None
+        """
+        return None
+
+    def load_history(self):
+        """
+        Read the token times saved by earlier runs, and from them how many
+        seconds each kind of token takes per byte of input
+        """
+        path = self.get_history_file()
+        if not path or not os.path.exists(path):
+            return
+        try:
+            entries = to_bytes(json.load(open(path)))
+        except ValueError:
+            logger.warning('Ignoring unreadable token history [%s]' % path)
+            return
+        self.history = dict([((kind, name), (seconds, size)) for (kind, name, seconds, size) in entries])
+        totals = {}
+        for ((kind, _), (seconds, size)) in self.history.items():
+            if size:
+                total = totals.setdefault(kind, [0.0, 0])
+                total[0] += seconds
+                total[1] += size
+        self.rates = dict([(kind, seconds / size) for (kind, (seconds, size)) in totals.items()])
+        logger.info('Read the times of %d tokens from [%s]' % (len(self.history), path))
+
+    def save_history(self):
+        """
+        Save the token times of this run along with those of earlier runs
+        for tokens it didn't run
+        """
+        path = self.get_history_file()
+        if path:
+            out = open(path, 'w')
+            json.dump(sorted([[kind, name, seconds, size] for ((kind, name), (seconds, size))
+                in self.history.items()]), out)
+            out.close()
+
     def get_map_tokens(self):
         raise 'Need to implement get_map_tokens'
 
+    def get_partitions(self):
+        """
+        How many partitions each map task should split its output into. When
+        the shuffle is skipped there is no point splitting it.
+        """
+        if self.skip_shuffle:
+            return 1
+        return ShufflePartitions
+
+    def result_codec(self):
+        """
+        The codec clients should write the final shards with, or None to
+        leave it to them
+        """
+        return None
+
     def get_shuffle_tokens(self):
-        #shuffle_keys = []
-        #for s in string.lowercase:
-        #    for s2 in string.lowercase:
-        #        shuffle_keys.append(s+s2)
-        #for s in string.uppercase:
-        #    for s2 in string.lowercase+string.uppercase:
-        #        shuffle_keys.append(s+s2)
-        #
-        #return dict([(('shuffle', shard), Token()) for shard in shuffle_keys])
-        # return dict([(('shuffle', shard), Token()) for shard in string.lowercase+string.uppercase])
-        return dict([(('shuffle', tuple(g)), Token()) for g in
-            group(list(self.shuffle_keys), ShuffleKeysPerShard)])
+        return dict([(('shuffle', partition), Token()) for partition in
+            range(self.get_partitions())])
 
     def end_task(self):
         raise 'Need to implement end_task'
 
+    def fail_task(self):
+        """
+        Give up on the job once a token has failed MaxTokenAttempts times. The
+        journal is kept, so a rerun picks up where this one stopped.
+        """
+        logger.error( 'Job failed: %s' % self.failed )
+        self.terminate_servers()
+
+    def terminate_servers(self):
+        # Kill remaining servers
+        logger.info('killing')
+
+        # Tell all the condor jobs to terminate
+        live_servers_lock.acquire()
+        for (i, (server, port)) in enumerate(live_servers):
+            try:
+                logger.info('killing %d: %s:%d' % (i, server, port ))
+                self.get_rpc(server, port).terminate()
+            except:
+                logger.info('not killing %s:%d' % (server, port ))
+        live_servers_lock.release()
+
     def process_result(self, result, live_server, token):
         """
         Munge the result from a client and add the data into our repository.
@@ -351,39 +1968,63 @@ class Mothership(threading.Thread):
         # Ensures that duplicated work is not accepted after the
         # token has been consumed (to prevent previous generation's
         # evals from affecting the current gen)
+        counters = result.pop('COUNTERS', {})
         if not result.has_key('FAILED'):
-            if token in self.Tokens.keys():
+            if token in self.Tokens:
                 self.data_lock.acquire()
                 if token[0] == 'map':
-                    (shard, shuffle_keys) = result.values()[0]
-                    self.shuffle_keys.update(shuffle_keys)
-                    logger.info('Have %d shuffle keys (only alpha)' % (len(self.shuffle_keys)))
-                    self.map_result_shards.append(shard)
+                    self.map_result_shards[token] = result.values()[0]
                 elif token[0] == 'shuffle':
                     self.shuffle_result_shards.append(result.values()[0])
+                elif token[0] == 'sample':
+                    self.samples.extend(result.values()[0])
+                # Only the attempt we accept counts, so retried and
+                # speculative attempts aren't counted twice
+                self.add_counters(counters)
+                self.token_counters[token] = counters
                 self.data_lock.release()
 
+                if self.journal and token[0] != 'sample':
+                    self.journal.write({'token':token, 'result':result.values()[0],
+                        'counters':counters})
+
                 # Consume the token if we've performed enough Evals
                 self.print_complete(token, self.Tokens, live_server, live_servers, idle_servers)
                 del self.Tokens[token]
             else: # Delete extraneous data
                 if token[0] == 'map':
-                    (shard, shuffle_keys) = result.values()[0]
-                    os.remove(shard)
+                    # Those on a client's disk go when it does
+                    for shard in result.values()[0]:
+                        if not parse_url(shard):
+                            os.remove(shard)
+                elif token[0] == 'shuffle':
+                    os.remove(result.values()[0])
             
 
     def print_complete(self, token, tokens, live_server, live_servers, idle_servers):
         pass
 
     def farm_eval_to(self, (server,port)):
-        """ Precondition: we're inside the live_servers_lock and token lock """
-        # First farm out the unfarmed tokens, then farm out the incomplete tokens
-        unfarmed_tokens = [x for x in self.Tokens.keys() if not self.Tokens[x].farmed]
-        if unfarmed_tokens:
-            token = choice(unfarmed_tokens)
+        """ Precondition: we're inside the live_servers_lock and token lock.
+        Returns False if there was nothing worth giving to this server. """
+        # First farm out the unfarmed tokens, preferring ones whose input this
+        # host already has, then speculatively duplicate the stragglers. Early
+        # reducers all wait for the slowest map, so a copy of a straggling map
+        # comes before them.
+        token = self.next_local_token((server,port)) or self.next_ready_token(server)
+        copy = None
+        if not token or (token[0] == 'shuffle' and self.maps_left()):
+            copy = self.pick_speculative_token((server,port))
+        if copy:
+            if token:
+                self.push_ready(token)
+            token = copy
+            logger.info( "Speculatively re-running %s" % str(token) )
+        elif token:
             self.Tokens[token].farmed = True
         else:
-            token = choice(self.Tokens.keys()) 
+            return False
+        self.Tokens[token].started[(server,port)] = time.time()
             
         logger.debug( "Assigning Token %s to %s:%d" % (str(token), server, port) )
 
@@ -391,45 +2032,118 @@ class Mothership(threading.Thread):
         p = threading.Thread(target=self.handle_token_on_server, args=((server,port), token))
         p.daemon = True
         p.start()
+        return True
+
+    def dispatch(self):
+        """
+        Hand out work to idle slots: waiting tokens first, one per slot, then
+        speculative copies to whichever slots are left. Precondition: we're
+        inside the live_servers_lock and token lock.
+        """
+        # Slots that get nothing go back at the end; each is offered work once
+        for i in range(len(idle_servers)):
+            if not self.Tokens:
+                break
+            idle_server = idle_servers.popleft()
+            try:
+                if self.farm_eval_to(idle_server):
+                    continue
+            except Exception, detail:
+                logger.error( 'Could not start thread for %s because of %s' % (idle_server, detail) )
+            idle_servers.append(idle_server)
+
+        # Early reducers only get slots no map wants, but a lost client or a
+        # straggler can leave maps waiting for a slot (or a copy) while every
+        # slot holds a reducer waiting for them; free one by cancelling the
+        # reducer started last
+        if not idle_servers and self.early_attempts and self.maps_left():
+            self.preempt_reducer()
+
+    def preempt_reducer(self):
+        """
+        Cancel the early reducer started last, if a map is waiting for a slot
+        or a map worth copying could have its slot, unless one is already
+        being cancelled. Precondition: we're inside the token lock.
+        """
+        candidates = [(token, live_server) for (token, live_server) in self.early_attempts
+                if token in self.Tokens]
+        if not candidates or self.early_attempts & self.preempted:
+            return
+        (token, live_server) = max(candidates,
+                key=lambda (token, live_server): self.Tokens[token].started.get(live_server, 0))
+        if not self.maps_waiting() and not self.pick_speculative_token(live_server):
+            return
+        logger.info('Cancelling %r on %s:%d to make room for maps' % ((token,) + live_server))
+        self.preempted.add((token, live_server))
+        self.cancel_token_on(live_server, token)
 
     def run(self):
         """ Run forever, taking into account that various NEAT instances can
         join and leave. The universal interface to the clients is through the
         tokens identified by a moniker. """
         logger.info( "Starting mothership..." )
+        global current_job
+        current_job = self
+
+        monitor = threading.Thread(target=self.poll_progress)
+        monitor.daemon = True
+        monitor.start()
+
+        watcher = threading.Thread(target=self.watch_heartbeats)
+        watcher.daemon = True
+        watcher.start()
+
+        if self.status_port:
+            try:
+                StatusServer(self.status_port, self.status, StatusHost).start()
+            except socket.error, detail:
+                logger.warning('Could not serve status on port %d: %r' % (self.status_port, detail))
+
+        schedule_event.set()
         while True:
-            time.sleep(FarmRate)
+            # Wait until something changes; time passing alone can also make
+            # a straggler worth duplicating
+            schedule_event.wait(ProgressRate)
+            schedule_event.clear()
+            if self.failed:
+                break
 
             # Check to see if we spent all the tokens for a particular game
             self.Tokens_lock.acquire()
             # End the current epoch and begin the next
-            if not self.Tokens.keys():
-                if self.shuffled or self.skip_shuffle:
+            if not self.Tokens:
+                if self.sampling:
+                    self.finish_sampling()
+                elif self.shuffled or self.skip_shuffle:
                     # If we skip the shuffle step, send the map shards directly
                     # to the output
                     if self.skip_shuffle:
-                        self.shuffle_result_shards = self.map_result_shards
+                        self.shuffle_result_shards = [shard for token in
+                                sorted(self.map_result_shards) for shard in self.map_result_shards[token]]
+                    else:
+                        # Named REDUCE-<partition>-..., so this puts them in
+                        # partition order, which is key order when the
+                        # partitions are ranges
+                        self.shuffle_result_shards.sort(key=os.path.basename)
                             
                     break
                 else:
-                    self.Tokens = self.get_shuffle_tokens()
-                    logger.info('Starting on %d shuffle shards...' % len(self.Tokens))
-                    self.shuffled = True
+                    self.start_shuffle()
+            elif self.slow_start_due():
+                self.start_shuffle()
 
-            # Try periodically to farm out jobs
             live_servers_lock.acquire()
-            if self.Tokens.keys(): # Don't proceed unless we have tokens
-                for idle_server in idle_servers:
-                    try:
-                        idle_servers.remove(idle_server)
-                        self.farm_eval_to(idle_server)
-                    except Exception, detail:
-                        logger.error( 'Could not start thread for %s because of %s' % (idle_server, detail) )
-                        
-            live_servers_lock.release()
-            self.Tokens_lock.release()
-
-        self.end_task()
+            try:
+                self.dispatch()
+            finally:
+                live_servers_lock.release()
+                self.Tokens_lock.release()
+
+        self.finished = True
+        if self.failed:
+            self.fail_task()
+        else:
+            self.end_task()
 
 
 class BZ2ShardedMothership(Mothership):
@@ -437,18 +2151,51 @@ class BZ2ShardedMothership(Mothership):
     For simple sharded mothership, look in the data directory and make as tokens all of the
     files that you see in there.
     """
+    FinalCodec = 'bz2'  # Codec for the merged OutputFile, see ufo.compression
+
+    # How merge_results puts the final shards together:
+    #   'reencode' decompresses every shard and compresses it again into
+    #              OutputFile on the Mothership
+    #   'concat'   has the clients write the shards with FinalCodec and just
+    #              appends their bytes to OutputFile
+    #   'manifest' leaves the shards where they are and lists them, one per
+    #              line, in OutputFile.manifest
+    # Every mode keeps the shards in partition order, which is key order with
+    # SortedOutput.
+    MergeMode = 'reencode'
+
+    # Shards bigger than this many compressed bytes are split into several map
+    # tokens, each covering a run of bz2 blocks; None keeps one token a shard
+    SplitSize = 64 * 1024 * 1024
+
     def initialize(self, base_path, shards_to_use):
         self.base_path = base_path
         assert os.path.exists(self.base_path)
 
-        self.shards = ['%s/%s' % (self.base_path, file) for file in os.listdir(self.base_path) if file.endswith('.bz2') and file.find('result') < 0]
+        self.shards = list_shards(self.base_path)
         if shards_to_use < len(self.shards):
             self.shards = sample(self.shards, shards_to_use)
 
         logger.info('Got %d shards from [%s]' % (len(self.shards), self.base_path))
 
     def get_map_tokens(self):
-        return dict([(('map',shard), Token()) for shard in self.shards])
+        tokens = []
+        for shard in self.shards:
+            tokens.extend(split_shard(shard, self.SplitSize))
+        if len(tokens) > len(self.shards):
+            logger.info('Split %d shards into %d tokens' % (len(self.shards), len(tokens)))
+        return dict([(('map',token), Token()) for token in tokens])
+
+    def get_journal_file(self):
+        if Journaling:
+            return '%s.journal' % self.OutputFile
+        return None
+
+    def get_counters_file(self):
+        return '%s.counters.json' % self.OutputFile
+
+    def get_history_file(self):
+        return '%s.history.json' % self.OutputFile
 
     def print_complete(self, token, tokens, live_server, live_servers, idle_servers):
         logger.info('COMPLETE [%r] (%d remaining) on server %s:%d (%d total, %d idle)' %
@@ -458,42 +2205,88 @@ class BZ2ShardedMothership(Mothership):
         """
         This default end_task just merges all of the shuffled data to the local disk
         """
-        # Kill remaining servers
-        logger.info('killing')
-
-        # Tell all the condor jobs to terminate
-        live_servers_lock.acquire()
-        for (i, (server, port)) in enumerate(live_servers):
-            try:
-                logger.info('killing %d: %s:%d' % (i, server, port ))
-                get_rpc(server, port).terminate()
-            except:
-                logger.info('not killing %s:%d' % (server, port ))
-        live_servers_lock.release()
+        self.terminate_servers()
+        self.finish_output()
+        logger.info('done.')
+        sys.exit()
 
+    def finish_output(self):
         # Now write the output to disk
         logger.info('Merging to local disk...')
         self.merge_results()
         logger.info('done writing.')
+        self.report_counters()
+        self.save_history()
 
-        logger.info('done.')
-        sys.exit()
+        # The task is finished, so a rerun should start from scratch
+        if self.journal:
+            self.journal.remove()
+
+    def result_codec(self):
+        if self.MergeMode in ('concat', 'manifest'):
+            return self.FinalCodec
+        return None
 
     def merge_results(self):
+        if self.MergeMode == 'reencode':
+            self.reencode_results()
+        elif self.MergeMode == 'concat':
+            self.concat_results()
+        elif self.MergeMode == 'manifest':
+            self.write_manifest()
+        else:
+            raise ValueError('Unknown MergeMode %r' % self.MergeMode)
+
+    def reencode_results(self):
         """
-        Just do a passthru merge
+        Just do a passthru merge, recompressing each shard with FinalCodec
         """
-        writer = codecs.getwriter('utf8')(BZ2File(self.OutputFile, 'w'))
+        writer = get_codec(self.FinalCodec).writer(self.OutputFile)
         for (i, shard) in enumerate(self.shuffle_result_shards):
             logger.info('  processing shard %d' % i)
-            f = codecs.getreader('utf8')(BZ2File(shard))
-            for (line_no, line) in enumerate(f): 
-                # print line.encode('utf8','replace'),
-                writer.write(line)
-            f.close()
+            reader = InputReader(shard)
+            for data in iter(lambda: reader.read(ReadSize), ''):
+                writer.write(data)
+            reader.close()
 
         writer.close()
 
+    def concat_results(self):
+        """
+        Append the compressed bytes of each shard to OutputFile, which makes a
+        valid multi-stream file at the speed of a copy
+        """
+        codec = get_codec(self.FinalCodec)
+        output = open(self.OutputFile, 'wb')
+        for (i, shard) in enumerate(self.shuffle_result_shards):
+            logger.info('  appending shard %d' % i)
+            if codec_for_path(shard) is codec:
+                f = open(shard, 'rb')
+                shutil.copyfileobj(f, output, ReadSize)
+                f.close()
+            else:
+                # Written with some other codec (e.g. recovered from a journal),
+                # so this one has to be recompressed
+                reader = InputReader(shard)
+                compressor = codec.compressor()
+                for data in iter(lambda: reader.read(ReadSize), ''):
+                    if compressor:
+                        data = compressor.compress(data)
+                    output.write(data)
+                if compressor:
+                    output.write(compressor.flush())
+                reader.close()
+        output.close()
+
+    def write_manifest(self):
+        """
+        List the final shards in place of merging them
+        """
+        manifest = open('%s.manifest' % self.OutputFile, 'w')
+        for shard in self.shuffle_result_shards:
+            manifest.write('%s\n' % os.path.abspath(shard))
+        manifest.close()
+
 def start_ufo(UFOMapper, UFOMothership):
     """
     Actually handles starting up the client or server depending on command line context.
@@ -501,9 +2294,15 @@ def start_ufo(UFOMapper, UFOMothership):
     import sys
     if sys.argv[1] == '--client':
         if len(sys.argv) < 3:
-            print "usage: %s --client 'mothership'" % sys.argv[0]
+            print "usage: %s --client 'mothership' [--slots N]" % sys.argv[0]
             sys.exit()
-        UFOMapper(sys.argv[2], sys.argv[3:])
+        # --slots N runs up to N tokens at once, with any remaining arguments
+        # going to the mapper
+        args = sys.argv[3:]
+        if len(args) > 1 and args[0] == '--slots':
+            UFOMapper.Slots = int(args[1])
+            args = args[2:]
+        UFOMapper(sys.argv[2], args).serve()
 
     else:
         import os
@@ -513,9 +2312,18 @@ def start_ufo(UFOMapper, UFOMothership):
             runner.skip_shuffle = True
         elif sys.argv[3] == '--shuffle':
             runner.skip_shuffle = False
+
+        # --local N runs everything on this machine in N processes, with any
+        # remaining arguments going to the mapper
+        if len(sys.argv) > 5 and sys.argv[4] == '--local':
+            runner.start_local_workers(UFOMapper, sys.argv[6:], int(sys.argv[5]))
+        else:
+            runner.start_registry()
         runner.start_task(sys.argv[1], sys.argv[2])
         time.sleep(1) 
 
         # Monitor for the oending condition
         runner.start()
         runner.join()
+        if runner.failed:
+            sys.exit(1)
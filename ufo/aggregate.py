@@ -0,0 +1,155 @@
+"""
+Bounded memory for mappers that add up counts per key before outputting
+anything (term frequencies, context counts, pair statistics, ...). Rather
+than a defaultdict that grows with the shard, an Aggregator holds partial
+sums up to a byte budget and then spills them to disk as a run sorted by
+key. Iterating over it merges the runs with what is still in memory, adding
+up the partial sums of each key, so every key comes out once, in order.
+
+A value is a number or a fixed length vector of them, a tuple or list,
+which is added up element by element. Keys are strings or tuples of them.
+Runs are written with marshal, so keys and values must be of types it
+handles.
+"""
+import os, marshal, tempfile
+from heapq import merge
+from itertools import groupby
+
+EntrySize  = 100  # Rough bytes of dict slot and objects behind each entry,
+                  # on top of the characters of its key
+VectorSize = 32   # Rough bytes of each element of a vector value
+
+def entry_size(key, value):
+    """
+    About how much memory key and its value take up in the table
+    """
+    size = EntrySize
+    if isinstance(key, tuple):
+        size += sum([len(k) for k in key]) + EntrySize // 2 * len(key)
+    else:
+        size += len(key)
+    if isinstance(value, (tuple, list)):
+        size += VectorSize * len(value)
+    return size
+
+def add_values(total, value):
+    """
+    total plus value; vectors are added into total in place
+    """
+    if isinstance(total, list):
+        for (i, v) in enumerate(value):
+            total[i] += v
+        return total
+    return total + value
+
+def write_run(entries, spill_dir=None):
+    """
+    Write sorted (key, value) entries to a temporary run file and return its
+    path
+    """
+    (fd, path) = tempfile.mkstemp(prefix='ufo-sums-', dir=spill_dir)
+    f = os.fdopen(fd, 'wb')
+    for entry in entries:
+        marshal.dump(entry, f)
+    f.close()
+    return path
+
+def read_run(path):
+    """
+    Lazily yield the entries of a run file, which is unlinked as soon as it
+    is opened
+    """
+    f = open(path, 'rb')
+    os.remove(path)
+    while True:
+        try:
+            yield marshal.load(f)
+        except EOFError:
+            break
+    f.close()
+
+def sum_entries(entries):
+    """
+    Add up consecutive entries with the same key
+    """
+    for (key, group) in groupby(entries, lambda (k, v): k):
+        (_, total) = group.next()
+        if isinstance(total, tuple):
+            total = list(total)
+        for (_, value) in group:
+            total = add_values(total, value)
+        yield (key, total)
+
+
+class Aggregator:
+    """
+    Adds up values per key in at most about budget bytes, spilling the
+    partial sums to disk as a sorted run whenever they outgrow it.
+    on_spill, if given, is called after each spill.
+    """
+    def __init__(self, budget, spill_dir=None, fan_in=100, on_spill=None):
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self.fan_in = fan_in
+        self.on_spill = on_spill
+
+        self.table = {}
+        self.size = 0  # Approximate size of the table in bytes
+        self.runs = []  # Paths of the runs spilled so far
+
+    def add(self, key, value=1):
+        total = self.table.get(key)
+        if total is None:
+            if isinstance(value, tuple):
+                value = list(value)
+            elif isinstance(value, list):
+                value = value[:]
+            self.table[key] = value
+            self.size += entry_size(key, value)
+            if self.size >= self.budget:
+                self.spill()
+        else:
+            self.table[key] = add_values(total, value)
+
+    def spill(self):
+        """
+        Write the partial sums out as a new run and empty the table
+        """
+        if self.table:
+            entries = sorted(self.table.iteritems())
+            self.table = {}
+            self.size = 0
+            self.runs.append(write_run(entries, self.spill_dir))
+            if self.on_spill:
+                self.on_spill()
+
+    def __iter__(self):
+        """
+        Yield (key, total) for every key in key order. Vector totals are
+        lists. The Aggregator is empty afterwards, but for any runs it
+        leaves unread if it isn't read to the end; close() removes those.
+        """
+        if not self.runs:
+            entries = sorted(self.table.iteritems())
+            self.table = {}
+            self.size = 0
+            return iter(entries)
+
+        self.spill()
+        runs = self.runs
+        while len(runs) > self.fan_in:
+            merged = sum_entries(merge(*[read_run(path) for path in runs[:self.fan_in]]))
+            runs = runs[self.fan_in:] + [write_run(merged, self.spill_dir)]
+            self.runs = runs  # Left for close() if we're not read to the end
+        return sum_entries(merge(*[read_run(path) for path in runs]))
+
+    def close(self):
+        """
+        Remove any runs left on disk
+        """
+        for path in self.runs:
+            if os.path.exists(path):
+                os.remove(path)
+        self.runs = []
+        self.table = {}
+        self.size = 0
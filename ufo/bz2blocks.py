@@ -0,0 +1,284 @@
+"""
+Splitting bz2 files at block boundaries. A bz2 stream is a 'BZh' header
+followed by blocks of up to 900k of input each, every one starting with a 48
+bit magic number that need not be byte aligned, and ends with another magic
+number and a CRC of the whole stream. Blocks can be decompressed on their own,
+so a large file can be split into tokens that each cover a range of blocks.
+
+A token for a range is written 'path@start-end' where start and end are bit
+offsets into the file. To read one we copy its blocks, shifted into byte
+alignment, into a stream of their own with a fresh header and trailer.
+
+Finding the blocks means scanning the whole file, so the offsets are saved
+next to it as path.blocks and reused while the file is unchanged. bzip-table
+style indexes with 'start end' bit offsets on each line can be dropped in
+there too.
+"""
+import os, sys, mmap, bz2
+from binascii import hexlify, unhexlify
+
+BlockMagic = 0x314159265359
+EndMagic   = 0x177245385090
+FirstBlock = 32  # Bit offset of the first block, just after 'BZh9'
+
+IndexSuffix = '.blocks'
+ChunkSize = 1024 * 1024  # Bytes of blocks shifted into alignment at once
+SearchWindow = 16 * 1024 * 1024  # Bytes searched at a time for the next block
+
+def read_bits(data, bit, count):
+    """
+    The count bits starting at bit offset bit as an integer, or None if
+    they run past the end of data
+    """
+    first = bit // 8
+    last = (bit + count + 7) // 8
+    if last > len(data):
+        return None
+    if not count:
+        return 0  # A byte aligned offset would give us no bytes to convert
+    chunk = data[first:last]
+    extra = len(chunk) * 8 - bit % 8 - count
+    return (int(hexlify(chunk), 16) >> extra) & ((1 << count) - 1)
+
+def to_bytes(value, length):
+    return unhexlify('%0*x' % (length * 2, value))
+
+def shifted_bytes(data, bit, length):
+    """
+    length bytes' worth of data starting at bit offset bit
+    """
+    first = bit // 8
+    shift = bit % 8
+    if not shift:
+        return data[first:first+length]
+    value = int(hexlify(data[first:first+length+1]), 16) >> (8 - shift)
+    return to_bytes(value & ((1 << length * 8) - 1), length)
+
+def find_markers(data, magic, start=0, end=None):
+    """
+    Sorted bit offsets of the 48 bit magic in data between bit offsets
+    start and end. Each of the eight possible alignments of the magic has at
+    least five whole bytes fixed, which we can search for quickly.
+    """
+    if end is None:
+        end = len(data) * 8
+    found = []
+    for shift in range(8):
+        if shift:
+            window = to_bytes(magic << (8 - shift), 7)
+            (pattern, lead) = (window[1:6], 1)
+        else:
+            (pattern, lead) = (to_bytes(magic, 6), 0)
+        i = data.find(pattern, max(start // 8 - 1, 0), min(end // 8 + 7, len(data)))
+        while i >= 0:
+            bit = (i - lead) * 8 + shift
+            if bit >= end:
+                break
+            if bit >= start and read_bits(data, bit, 48) == magic:
+                found.append(bit)
+            i = data.find(pattern, i + 1, min(end // 8 + 7, len(data)))
+    found.sort()
+    return found
+
+def find_next(data, magic, start):
+    """
+    Offset of the first magic at or after bit offset start, or None
+    """
+    while start < len(data) * 8:
+        found = find_markers(data, magic, start, start + SearchWindow * 8)
+        if found:
+            return found[0]
+        start += SearchWindow * 8 - 48
+    return None
+
+def scan_blocks(data):
+    """
+    The (start, end) bit offsets of every block, where end is where the next
+    block or the end of the stream begins
+    """
+    starts = find_markers(data, BlockMagic)
+    markers = sorted(starts + find_markers(data, EndMagic))
+    blocks = []
+    for (i, marker) in enumerate(markers[:-1]):
+        if read_bits(data, marker, 48) == BlockMagic:
+            blocks.append((marker, markers[i+1]))
+    return blocks
+
+def open_data(path):
+    """
+    Map a file into memory for scanning; returns (file, data)
+    """
+    f = open(path, 'rb')
+    if not os.path.getsize(path):
+        return (f, '')
+    return (f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+def block_index(path):
+    """
+    The blocks of path, from its saved index if that is still up to date
+    """
+    index = path + IndexSuffix
+    if os.path.exists(index) and os.path.getmtime(index) >= os.path.getmtime(path):
+        return [tuple(map(int, line.split()[:2])) for line in open(index) if line.strip()]
+
+    (f, data) = open_data(path)
+    blocks = scan_blocks(data)
+    f.close()
+    try:
+        out = open(index, 'w')
+        for (start, end) in blocks:
+            out.write('%d\t%d\n' % (start, end))
+        out.close()
+    except IOError:
+        pass  # Nowhere to save it; we'll scan again next time
+    return blocks
+
+def split_shard(path, split_size):
+    """
+    Tokens covering path in ranges of about split_size compressed bytes.
+    Ranges never cross from one stream of a multi-stream file into the next.
+    """
+    if not split_size or os.path.getsize(path) <= split_size:
+        return [path]
+    ranges = []
+    for (start, end) in block_index(path):
+        if ranges and ranges[-1][1] == start and end - ranges[-1][0] <= split_size * 8:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    if len(ranges) < 2:
+        return [path]
+    return ['%s@%d-%d' % (path, start, end) for (start, end) in ranges]
+
+def split_block_range(token):
+    """
+    Split a token into its path and (start, end) block range, which is None
+    for a whole file
+    """
+    (path, at, block_range) = token.rpartition('@')
+    if at and '-' in block_range:
+        (start, _, end) = block_range.partition('-')
+        if start.isdigit() and end.isdigit():
+            return (path, (int(start), int(end)))
+    return (token, None)
+
+
+class BlockRangeFile:
+    """
+    Read-only file holding the blocks between bit offsets start and end of a
+    bz2 file as a complete stream. It is followed by each later block of the
+    file as a stream of its own, so that a reader can carry on past the end
+    of its range to finish the record it is in the middle of.
+    """
+    def __init__(self, path, start, end):
+        (self.f, self.data) = open_data(path)
+        self.start = start
+        self.end = end
+        self.size = 4 + (end - start + 80 + 7) // 8  # Length of our own stream
+
+        self.chunks = self.generate_chunks()
+        self.pending = ''
+        self.position = 0
+
+    def generate_chunks(self):
+        for chunk in self.stream(self.start, self.end):
+            yield chunk
+        bit = self.end
+        while True:
+            start = find_next(self.data, BlockMagic, bit)
+            if start is None:
+                return
+            ends = [x for x in [find_next(self.data, BlockMagic, start + 48),
+                    find_next(self.data, EndMagic, start + 48)] if x is not None]
+            if not ends:
+                return  # Truncated file
+            for chunk in self.stream(start, min(ends)):
+                yield chunk
+            bit = min(ends)
+
+    def stream(self, start, end):
+        """
+        Generate a bz2 stream of the blocks from start to end
+        """
+        crc = 0
+        for block in find_markers(self.data, BlockMagic, start, end):
+            crc = (((crc << 1) | (crc >> 31)) & 0xffffffff) ^ read_bits(self.data, block + 48, 32)
+
+        yield 'BZh9'  # The largest block size, so any block will fit
+        bit = start
+        while end - bit >= 8:
+            length = min(ChunkSize, (end - bit) // 8)
+            yield shifted_bytes(self.data, bit, length)
+            bit += length * 8
+
+        # The last few bits of the blocks, then the end of stream marker and
+        # the CRC, padded out to a whole byte
+        rest = end - bit
+        value = ((read_bits(self.data, bit, rest) << 48 | EndMagic) << 32) | crc
+        pad = (8 - (rest + 80) % 8) % 8
+        yield to_bytes(value << pad, (rest + 80 + pad) // 8)
+
+    def read(self, size=-1):
+        if 0 <= size and self.position < self.size:
+            size = min(size, self.size - self.position)  # Never straddle the end of our stream
+        while size < 0 or len(self.pending) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.pending += chunk
+        if size < 0:
+            size = len(self.pending)
+        data = self.pending[:size]
+        self.pending = self.pending[size:]
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if self.data:
+            self.data.close()
+        self.f.close()
+
+
+def decompress_all(data):
+    """
+    The data of every bz2 stream in data, one after another
+    """
+    out = []
+    while data:
+        decompressor = bz2.BZ2Decompressor()
+        out.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+    return ''.join(out)
+
+def check_split(path, split_size=None):
+    """
+    Whether the block ranges of path, each read as its own stream, put back
+    together give exactly what path decompresses to. The ranges are those
+    of split_shard with split_size, or each block on its own if None.
+    """
+    if split_size:
+        tokens = split_shard(path, split_size)
+    else:
+        tokens = ['%s@%d-%d' % (path, start, end) for (start, end) in block_index(path)]
+    pieces = []
+    for token in tokens:
+        (_, at, block_range) = token.rpartition('@')
+        if not at:
+            return True  # A single token reads the file as it is
+        (start, end) = map(int, block_range.split('-'))
+        f = BlockRangeFile(path, start, end)
+        pieces.append(bz2.decompress(f.read(f.size)))
+        f.close()
+    return ''.join(pieces) == decompress_all(open(path, 'rb').read())
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print 'usage: %s file.bz2 [split_size]' % sys.argv[0]
+        sys.exit(1)
+    split_size = len(sys.argv) > 2 and int(sys.argv[2]) or None
+    ok = check_split(sys.argv[1], split_size)
+    print ok and 'ok' or 'MISMATCH'
+    sys.exit(not ok)
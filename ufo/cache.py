@@ -0,0 +1,132 @@
+"""
+A scratch cache of input files on a worker's local disk. Shards and side
+files normally live on a shared filesystem; copying them to local disk the
+first time they are used lets later tokens and later jobs on the same host
+read them locally instead of going back to the file server.
+
+Every worker on a host that uses the same directory shares the cache. An
+index file records where each copy came from and when it was last used, and
+the least recently used copies are evicted to keep the cache under its size
+limit. Copies are refreshed when the original's size or mtime changes.
+"""
+import os, shutil, fcntl, json, tempfile, time, zlib
+from journal import to_bytes
+
+class LocalCache:
+    def __init__(self, directory, size):
+        self.directory = directory
+        self.size = size  # Most bytes of copies to keep
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass  # Another worker on this host got there first
+
+        self.index_path = os.path.join(directory, 'index.json')
+        self.lock_path = os.path.join(directory, 'lock')
+        self.lock_file = None
+
+    def lock(self):
+        # Open the lock file every time: children forked from one worker would
+        # otherwise share a single lock
+        self.lock_file = open(self.lock_path, 'a')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+
+    def unlock(self):
+        self.lock_file.close()
+        self.lock_file = None
+
+    def read_index(self):
+        """
+        Maps each cached path to its copy's file name, size, the original's
+        mtime and when the copy was last used. Precondition: we hold the lock.
+        """
+        try:
+            f = open(self.index_path)
+            try:
+                return to_bytes(json.load(f))
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return {}
+
+    def write_index(self, index):
+        (fd, path) = tempfile.mkstemp(prefix='.index-', dir=self.directory)
+        f = os.fdopen(fd, 'w')
+        json.dump(index, f)
+        f.close()
+        os.rename(path, self.index_path)
+
+    def copy_path(self, entry):
+        return os.path.join(self.directory, entry['file'])
+
+    def cached_paths(self):
+        """
+        The original paths of everything currently in the cache
+        """
+        self.lock()
+        try:
+            index = self.read_index()
+        finally:
+            self.unlock()
+        return [path for (path, entry) in index.items() if
+                os.path.exists(self.copy_path(entry))]
+
+    def local_copy(self, path):
+        """
+        Path of an up to date copy of path in the cache, copying it in first
+        if need be. Falls back to path itself if it can't be cached.
+        """
+        stat = os.stat(path)
+        if stat.st_size > self.size:
+            return path
+
+        self.lock()
+        try:
+            index = self.read_index()
+            entry = index.get(path)
+            if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime \
+                    and os.path.exists(self.copy_path(entry)):
+                entry['used'] = time.time()
+                self.write_index(index)
+                return self.copy_path(entry)
+        finally:
+            self.unlock()
+
+        # Copy without holding the lock so other workers aren't held up
+        (fd, temp_path) = tempfile.mkstemp(prefix='.copy-', dir=self.directory)
+        os.close(fd)
+        try:
+            shutil.copyfile(path, temp_path)
+        except (IOError, OSError):
+            os.remove(temp_path)  # Most likely out of disk; read it remotely
+            return path
+
+        entry = {'file':'%08x-%s' % (zlib.crc32(path) & 0xffffffff, os.path.basename(path)),
+                 'size':stat.st_size, 'mtime':stat.st_mtime, 'used':time.time()}
+        self.lock()
+        try:
+            index = self.read_index()
+            index.pop(path, None)
+            self.evict(index, stat.st_size)
+            os.rename(temp_path, self.copy_path(entry))
+            index[path] = entry
+            self.write_index(index)
+        finally:
+            self.unlock()
+        return self.copy_path(entry)
+
+    def evict(self, index, needed):
+        """
+        Remove least recently used copies until needed more bytes fit.
+        Precondition: we hold the lock.
+        """
+        entries = sorted(index.items(), key=lambda (path, entry): entry['used'])
+        total = sum([entry['size'] for (path, entry) in entries])
+        for (path, entry) in entries:
+            if total + needed <= self.size:
+                break
+            if os.path.exists(self.copy_path(entry)):
+                os.remove(self.copy_path(entry))
+            del index[path]
+            total -= entry['size']
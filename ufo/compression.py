@@ -0,0 +1,72 @@
+"""
+Codecs for the files jobs write. Intermediate files (map and shuffle
+outputs) only live for the length of a job, so they are usually better off
+with a fast codec, while final outputs can keep using bzip2. Files are named
+with their codec's extension so a reader can always tell which codec to use.
+
+Every codec here allows whole files to be concatenated into one valid file,
+but note that Python 2's BZ2File stops reading at the end of the first bz2
+stream; read such files with ufo.open_result (or bzcat) instead.
+"""
+import zlib, gzip
+from bz2 import BZ2File, BZ2Compressor, BZ2Decompressor
+
+GzipLevel = 1  # zlib compression level used for gzip files
+
+class BZ2Codec:
+    """ Small files but slow to write """
+    Name = 'bz2'
+    Extension = '.bz2'
+
+    def writer(self, path):
+        return BZ2File(path, 'w')
+
+    def compressor(self):
+        return BZ2Compressor()
+
+    def decompressor(self):
+        return BZ2Decompressor()
+
+class GzipCodec:
+    """ zlib deflate at a low level, in gzip framing so zcat can read it """
+    Name = 'gzip'
+    Extension = '.gz'
+
+    def writer(self, path):
+        return gzip.GzipFile(path, 'wb', GzipLevel)
+
+    def compressor(self):
+        return zlib.compressobj(GzipLevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def decompressor(self):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+class RawCodec:
+    """ No compression at all """
+    Name = 'raw'
+    Extension = ''
+
+    def writer(self, path):
+        return open(path, 'wb')
+
+    def compressor(self):
+        return None
+
+    def decompressor(self):
+        return None
+
+Codecs = dict([(codec.Name, codec) for codec in [BZ2Codec(), GzipCodec(), RawCodec()]])
+
+def get_codec(name):
+    if name not in Codecs:
+        raise ValueError('Unknown codec %r (choose from %s)' % (name, ', '.join(sorted(Codecs))))
+    return Codecs[name]
+
+def codec_for_path(path):
+    """
+    The codec a file was written with, going by its extension
+    """
+    for codec in Codecs.values():
+        if codec.Extension and path.endswith(codec.Extension):
+            return codec
+    return Codecs['raw']
@@ -0,0 +1,152 @@
+"""
+Moving map outputs from the clients that wrote them to the reducers that
+read them. With LocalShuffle each map token writes its partition files to
+its own client's local disk and names them in its result by URL:
+
+    ufo://host:port/path/of/the/file
+
+Each reducer then copies the files of its partition from those clients
+through their fetch call, several at a time, into a scratch directory of
+its own before merging them. Shuffle traffic goes between the clients
+rather than all of it through the file server holding the input.
+
+A reducer that can't fetch a file (its client died, say) fails with
+FetchFailed naming its URL, and the Mothership runs that map token again.
+"""
+import os, re, socket, threading
+from wire import ConnectionPool, RemoteError
+
+Scheme = 'ufo://'
+FetchSize = 4 * 1024 * 1024  # Bytes asked for in each call
+
+class FetchFailed(Exception):
+    """ Raised in a reducer when it can't fetch a map output; the message
+    is its URL """
+    pass
+
+def shard_url(host, port, path):
+    """
+    The URL of a map output at path on the client at host:port
+    """
+    return '%s%s:%d%s' % (Scheme, host, port, os.path.abspath(path))
+
+def parse_url(url):
+    """
+    (host, port, path) of a map output URL, or None if it is a plain path
+    """
+    if not url.startswith(Scheme):
+        return None
+    (address, _, path) = url[len(Scheme):].partition('/')
+    (host, _, port) = address.rpartition(':')
+    return (host, int(port), '/' + path)
+
+def failed_fetch(error):
+    """
+    The URL a failed shuffle couldn't fetch, going by the error its call
+    raised, or None if it failed some other way
+    """
+    match = re.search(r'FetchFailed: (%s\S+)' % re.escape(Scheme), str(error))
+    return match and match.group(1)
+
+def shard_exists(pool, url, unreachable):
+    """
+    Is the map output url still there? Files on clients are asked for with
+    a fetch of no bytes. Clients that can't be reached are added to the set
+    unreachable, and everything on them counts as gone.
+    """
+    location = parse_url(url)
+    if location is None:
+        return os.path.exists(url)
+    (host, port, path) = location
+    if (host, port) in unreachable:
+        return False
+    try:
+        pool.call((host, port), 'fetch', (path, 0, 0))
+        return True
+    except RemoteError:
+        return False  # The client is up but no longer has it
+    except (EOFError, socket.error):
+        unreachable.add((host, port))
+        return False
+
+def read_chunk(root, path, offset, size):
+    """
+    The serving side of a fetch: up to size bytes of path from offset, or ''
+    at its end. Only files under root can be read.
+    """
+    real = os.path.realpath(path)
+    if not real.startswith(os.path.realpath(root) + os.sep):
+        raise ValueError('%s is not a map output' % path)
+    f = open(real, 'rb')
+    try:
+        f.seek(offset)
+        return f.read(size)
+    finally:
+        f.close()
+
+def fetch(pool, url, dest):
+    (host, port, path) = parse_url(url)
+    out = open(dest, 'wb')
+    try:
+        offset = 0
+        while True:
+            chunk = pool.call((host, port), 'fetch', (path, offset, FetchSize))
+            if not chunk:
+                break
+            out.write(chunk)
+            offset += len(chunk)
+    finally:
+        out.close()
+
+def fetch_shards(urls, directory, hostname, threads):
+    """
+    Local paths for the map outputs urls, in the same order. Plain paths and
+    files on this host are read where they are; the rest are copied into
+    directory, threads at a time. Raises FetchFailed for a file that can't
+    be fetched.
+    """
+    # A fresh pool, since we may be in a child forked from a process whose
+    # connections are in use
+    pool = ConnectionPool()
+    paths = list(urls)
+    todo = []
+    for (i, url) in enumerate(urls):
+        location = parse_url(url)
+        if location is None:
+            continue
+        (host, port, path) = location
+        if host == hostname and os.path.exists(path):
+            paths[i] = path
+        else:
+            paths[i] = os.path.join(directory, '%05d-%s' % (i, os.path.basename(path)))
+            todo.append((url, paths[i]))
+
+    failed = []
+    lock = threading.Lock()
+    def fetcher():
+        while True:
+            lock.acquire()
+            try:
+                if not todo or failed:
+                    return
+                (url, dest) = todo.pop()
+            finally:
+                lock.release()
+            try:
+                fetch(pool, url, dest)
+            except Exception:
+                lock.acquire()
+                failed.append(url)
+                lock.release()
+
+    workers = [threading.Thread(target=fetcher) for i in range(min(threads, len(todo)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    for address in set([parse_url(url)[:2] for url in urls if parse_url(url)]):
+        pool.discard(address)
+
+    if failed:
+        raise FetchFailed(failed[0])
+    return paths
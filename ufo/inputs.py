@@ -0,0 +1,241 @@
+"""
+Readers for map inputs and intermediate files. Rather than handing jobs a
+BZ2File we stream the compressed file through a decompressor ourselves, which
+lets the worker report how far through its input a token is and read any of
+the codecs in compression.
+
+A reader can also cover just a range of blocks of a bz2 file (see bz2blocks).
+Records are split between neighbouring ranges the way Hadoop splits lines: a
+range that doesn't start at the beginning of the file skips the line it
+starts in the middle of, and each range reads on past its end to finish the
+last line that starts inside it. When the job says where its records start
+(set_record_start) whole records are kept together the same way.
+"""
+import os
+from compression import codec_for_path
+from bz2blocks import BlockRangeFile, FirstBlock
+
+ReadSize = 1024 * 1024  # Compressed bytes read at a time
+
+class InputReader:
+    """
+    File-like reader over a compressed file that tracks its position in the
+    compressed input. check, if given, is called before every read from disk
+    so the owner can abort a task part way through. The codec is worked out
+    from the file name unless one is given. block_range is a (start, end)
+    pair of bit offsets to read only those blocks of a bz2 file.
+    """
+    def __init__(self, path, check=None, codec=None, block_range=None):
+        if block_range:
+            self.f = BlockRangeFile(path, *block_range)
+            self.size = self.f.size
+        else:
+            self.f = open(path, 'rb')
+            self.size = os.path.getsize(path)
+        self.check = check
+        self.block_range = block_range
+
+        self.codec = codec or codec_for_path(path)
+        self.decompressor = self.codec.decompressor()
+        self.buffer = ''
+        self.pos = 0  # Offset of the next unread byte in buffer
+        self.eof = False
+
+        self.chunk_start = 0  # Where the compressed data for the buffer starts
+        self.chunk_length = 0
+
+        # Offsets into the whole decompressed range, not the buffer
+        self.consumed = 0  # Offset of the start of buffer
+        self.limit = None  # Where the data of the range's own blocks ends
+        self.scan = None   # Start of the first line after limit not yet checked
+        self.stop = None   # Where our last record ends
+
+        self.skipping = bool(block_range) and block_range[0] > FirstBlock
+        self.skipped_partial = False
+        self.record_start = None
+
+    def set_record_start(self, marker):
+        """
+        Records start on a line containing marker, e.g. '<page>', rather than
+        every line being a record. Call before reading anything.
+        """
+        self.record_start = marker
+
+    def progress(self):
+        """
+        Fraction of the compressed input consumed so far
+        """
+        if not self.size:
+            return 1.0
+        consumed = self.chunk_start
+        if self.buffer:
+            # Credit the current chunk by how much of its output we've used
+            consumed += self.chunk_length * self.pos / float(len(self.buffer))
+        # A range reads a little past its own blocks to finish its last record
+        return min(consumed / float(self.size), 1.0)
+
+    def end(self):
+        """
+        Offset in buffer up to which data is ours to hand out
+        """
+        if self.skipping:
+            return self.pos
+        if self.stop is not None:
+            return self.stop - self.consumed
+        if self.scan is not None:
+            return self.scan - self.consumed
+        return len(self.buffer)
+
+    def fill(self):
+        """
+        Decompress more data onto the end of the buffer, returning False once
+        the input is exhausted
+        """
+        self.consumed += self.pos
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        available = self.end()
+        while self.stop is None:
+            if not self.decompress():
+                self.stop = self.consumed + len(self.buffer)
+            if self.skipping:
+                self.skip_to_record()
+            if self.limit is not None and self.stop is None and not self.skipping:
+                self.find_stop()
+            if self.end() - self.pos > available:
+                return True
+        return self.end() - self.pos > available
+
+    def decompress(self):
+        """
+        Decompress the next chunk of input onto the buffer, returning False
+        once there is no more
+        """
+        self.chunk_start = self.f.tell()
+        while not self.eof:
+            if self.check:
+                self.check()
+            data = self.f.read(ReadSize)
+            if not data:
+                self.eof = True
+                self.chunk_start = self.size
+                self.chunk_length = 0
+                break
+            # A range's own blocks end where the first stream does
+            own_blocks_done = self.block_range and self.limit is None and self.f.tell() >= self.size
+
+            decompressed = []
+            while data and self.decompressor:
+                try:
+                    decompressed.append(self.decompressor.decompress(data))
+                except EOFError:
+                    # The last stream ended exactly at a chunk boundary
+                    self.decompressor = self.codec.decompressor()
+                    continue
+                # Concatenated streams: carry on with a fresh decompressor
+                # over whatever followed the end of this one
+                data = self.decompressor.unused_data
+                if data:
+                    self.decompressor = self.codec.decompressor()
+            if not self.decompressor:
+                decompressed.append(data)  # Uncompressed
+
+            decompressed = ''.join(decompressed)
+            self.buffer += decompressed
+            if own_blocks_done:
+                self.limit = self.consumed + len(self.buffer)
+            if decompressed or own_blocks_done:
+                self.chunk_length = self.f.tell() - self.chunk_start
+                return True
+        return False
+
+    def past_limit(self, offset):
+        return self.limit is not None and self.consumed + offset > self.limit
+
+    def is_record_start(self, start, newline):
+        """
+        Whether a record starts with the line at start, which ends at newline
+        (or at the end of the buffer if newline is -1 and so far incomplete)
+        """
+        if self.record_start is None:
+            return True
+        if newline < 0:
+            newline = len(self.buffer)
+        return self.buffer.find(self.record_start, start, newline) >= 0
+
+    def skip_to_record(self):
+        """
+        Drop data up to the first record that starts inside our range: skip the
+        partial line we start in, then any lines before a record start
+        """
+        while self.skipping:
+            newline = self.buffer.find('\n', self.pos)
+            if self.past_limit(self.pos):
+                # Nothing starts in our range; it all belongs to the one before
+                self.stop = self.consumed + self.pos
+                self.skipping = False
+            elif not self.skipped_partial:
+                if newline < 0:
+                    return
+                self.pos = newline + 1
+                self.skipped_partial = True
+            elif self.is_record_start(self.pos, newline):
+                self.skipping = False
+            elif newline >= 0:
+                self.pos = newline + 1
+            elif self.stop is not None:
+                self.pos = len(self.buffer)  # No record starts in the rest of the input
+                self.skipping = False
+            else:
+                return  # Wait for the rest of the line
+
+    def find_stop(self):
+        """
+        Look for the end of our last record: the start of the first record
+        after limit
+        """
+        if self.scan is None:
+            newline = self.buffer.find('\n', max(self.limit - self.consumed, self.pos))
+            if newline < 0:
+                return
+            self.scan = self.consumed + newline + 1
+        while self.stop is None:
+            start = self.scan - self.consumed
+            newline = self.buffer.find('\n', start)
+            if self.is_record_start(start, newline):
+                self.stop = self.scan
+            elif newline >= 0:
+                self.scan = self.consumed + newline + 1
+            else:
+                return  # Wait for the rest of the line
+
+    def read(self, size=-1):
+        while (size < 0 or self.end() - self.pos < size) and self.fill():
+            pass
+        if size < 0:
+            size = self.end() - self.pos
+        data = self.buffer[self.pos:min(self.pos+size, self.end())]
+        self.pos += len(data)
+        return data
+
+    def readline(self, size=-1):
+        end = self.buffer.find('\n', self.pos, self.end())
+        while end < 0:
+            searched = self.end() - self.pos
+            if not self.fill():
+                end = self.end() - 1
+                break
+            end = self.buffer.find('\n', self.pos + searched, self.end())
+        line = self.buffer[self.pos:end+1]
+        self.pos = end + 1
+        return line
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            yield line
+
+    def close(self):
+        self.f.close()
@@ -0,0 +1,83 @@
+"""
+The Mothership's journal. It is an append-only file of JSON lines: a header
+describing the task followed by one entry for every token that completed,
+with the files it produced. A Mothership restarted after a crash replays it
+and only hands out the tokens that are still missing.
+"""
+import os, json
+
+def to_bytes(value):
+    """
+    json hands back unicode; turn strings (also inside lists and dicts) back
+    into the utf8 byte strings we wrote
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    if isinstance(value, list):
+        return [to_bytes(v) for v in value]
+    if isinstance(value, dict):
+        return dict([(to_bytes(k), to_bytes(v)) for (k, v) in value.items()])
+    return value
+
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+        self.good_size = 0  # Bytes of the existing journal that parsed
+
+    def replay(self):
+        """
+        Returns the header and entries of an existing journal, or (None, [])
+        if there isn't one
+        """
+        if not os.path.exists(self.path):
+            return (None, [])
+
+        records = []
+        f = open(self.path, 'rb')
+        for line in f:
+            if not line.endswith('\n'):
+                break  # A write cut short by the crash; ignore it
+            try:
+                records.append(to_bytes(json.loads(line)))
+            except ValueError:
+                break
+            self.good_size += len(line)
+        f.close()
+
+        if not records:
+            return (None, [])
+        return (records[0], records[1:])
+
+    def start(self, header):
+        """
+        Begin a fresh journal for a new task
+        """
+        self.f = open(self.path, 'wb')
+        self.write(header)
+
+    def resume(self):
+        """
+        Carry on appending to a replayed journal, dropping any partial record
+        """
+        self.f = open(self.path, 'r+b')
+        self.f.truncate(self.good_size)
+        self.f.seek(0, os.SEEK_END)
+
+    def write(self, record):
+        """
+        Append one record and make sure it is on disk before going on
+        """
+        self.f.write(json.dumps(record) + '\n')
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def remove(self):
+        """
+        Delete the journal once the task has finished for good
+        """
+        if self.f:
+            self.f.close()
+            self.f = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,338 @@
+"""
+Running several jobs one after another as a pipeline. Each Stage names the
+Mapper of a job and what it reads: a directory of shards like a normal job,
+or earlier stages whose final shards it maps over directly, without merging
+them into one file first. A stage that other jobs read as side data (say a
+term frequency table loaded in initialize) can also be merged into a file.
+
+    from ufo.pipeline import Stage, Pipeline, start_pipeline
+    import MRCountTermDocFrequency, MRGenerateContexts, MRComputeLDASim
+
+    term_freq = Stage('term-freq', MRCountTermDocFrequency.MyMapper, 'wikipedia',
+            output=MRGenerateContexts.TermFreqFile)
+    contexts = Stage('contexts', MRGenerateContexts.MyMapper, 'wikipedia',
+            uses=[term_freq], output='wikipedia-contexts.txt.bz2')
+    # Ranks the context vectors of the heads in sim-heads against every
+    # vector in the merged output of contexts
+    lda_sim = Stage('lda-sim', MRComputeLDASim.MyMapper, 'sim-heads',
+            args=[contexts.output, 'tfidf_weighted_jaccard'], uses=[contexts])
+
+    if __name__ == '__main__':
+        start_pipeline(Pipeline([term_freq, contexts, lda_sim], 'pipeline-work'))
+
+Start the script with [--local N] for the Mothership and with --client
+mothership [--slots N] for each client, as with start_ufo. Clients stay up
+for the whole pipeline and create each stage's Mapper the first time they
+get one of its tokens.
+
+Stages run one at a time, each after the stages it reads. When one finishes
+its shards are listed in work_dir/name.stage.json along with a fingerprint
+of its job's source, settings and inputs; a rerun of the pipeline skips every
+stage whose fingerprint is unchanged and whose files are all still there.
+"""
+import os, sys, json, hashlib, inspect, threading
+import ufo
+from ufo import Mapper, BZ2ShardedMothership, LocalWorkers, ClientRegistry, \
+        connection_pool, list_shards
+from wire import RpcProxy
+from journal import to_bytes
+from status import StatusServer
+from utils import logger
+
+class StageFailed(Exception):
+    """ Raised when a token of a stage ran out of attempts """
+    pass
+
+class Stage:
+    """
+    One job of a pipeline. inputs is a directory of shards, a Stage whose
+    final shards are read as this stage's inputs, or a list of them. uses
+    lists side files and Stages (which must have an output) the job reads
+    some other way; they only decide when the stage runs and whether it is
+    up to date. output also merges the final shards into that file. args go
+    to the Mapper's initialize, and any other keyword sets that Mothership
+    attribute (MergeMode, SortedOutput, SplitSize, ...) for this stage.
+    """
+    def __init__(self, name, mapper, inputs, args=[], shuffle=True, uses=[], output=None, **options):
+        self.name = name
+        self.mapper = mapper
+        if not isinstance(inputs, list):
+            inputs = [inputs]
+        self.inputs = inputs
+        self.args = args
+        self.shuffle = shuffle
+        self.uses = uses
+        self.output = output
+        self.options = options
+
+        for stage in uses:
+            if isinstance(stage, Stage) and not stage.output:
+                raise ValueError('Stage %s uses %s, which has no output file' % (name, stage.name))
+
+    def depends(self):
+        return [stage for stage in self.inputs + self.uses if isinstance(stage, Stage)]
+
+
+class PipelineWorker(Mapper):
+    """
+    The client for a pipeline. It serves the calls for every stage, named
+    'stage.method', and hands each to that stage's Mapper.
+    """
+    StageMethods = ['map', 'sample', 'shuffle', 'status', 'cancel']
+
+    def __init__(self, mothership, args, stages):
+        self.stages = dict([(stage.name, stage) for stage in stages])
+        self.mappers = {}  # Stage name -> its Mapper, once we've needed it
+        self.mappers_lock = threading.Lock()
+        Mapper.__init__(self, mothership, args)
+
+    def stage_mapper(self, name):
+        """
+        The Mapper for stage name. It is only made once the stage runs, so its
+        initialize can read what earlier stages wrote.
+        """
+        self.mappers_lock.acquire()
+        try:
+            if name not in self.mappers:
+                logger.info('Starting stage [%s]' % name)
+                stage = self.stages[name]
+                mapper = stage.mapper(None, stage.args)
+                # Name outputs and take calls as we do
+                mapper.hostname = self.hostname
+                mapper.Port = self.Port
+                mapper.Slots = self.Slots
+                mapper.rpcserver = self.rpcserver
+                mapper.mothership = self.mothership
+                # Share our tasks, so heartbeats and timeouts see them
+                mapper.tasks = self.tasks
+                mapper.tasks_lock = self.tasks_lock
+                mapper.orphans = self.orphans
+                self.mappers[name] = mapper
+            return self.mappers[name]
+        finally:
+            self.mappers_lock.release()
+
+    def register_rpcs(self, rpcserver):
+        rpcserver.register('terminate', self.rpc_terminate)
+        rpcserver.register('fetch', self.rpc_fetch)  # Map outputs of every stage
+        for name in self.stages:
+            for method in self.StageMethods:
+                rpcserver.register('%s.%s' % (name, method), self.stage_rpc(name, method))
+
+    def stage_rpc(self, name, method):
+        def call(meta, *args):
+            if method in ('status', 'cancel') and name not in self.mappers:
+                # Nothing of that stage is running; don't start it just to say so
+                return getattr(Mapper, 'rpc_' + method)(self, meta, *args)
+            return getattr(self.stage_mapper(name), 'rpc_' + method)(meta, *args)
+        return call
+
+
+class StageMothership(BZ2ShardedMothership):
+    """
+    Runs the tokens of one stage and leaves its final shards where they are,
+    for the next stage to read
+    """
+    MergeMode = 'manifest'
+
+    def __init__(self, stage, work_dir):
+        BZ2ShardedMothership.__init__(self)
+        self.stage = stage
+        self.OutputFile = '%s/%s.txt.bz2' % (work_dir, stage.name)
+        if stage.output:
+            self.OutputFile = stage.output
+            self.MergeMode = 'concat'
+        for (name, value) in stage.options.items():
+            setattr(self, name, value)
+        self.skip_shuffle = not stage.shuffle
+        self.status_port = None  # The pipeline serves one page for all stages
+
+    def initialize(self, base_path, shards):
+        self.base_path = base_path
+        self.shards = shards
+        logger.info('Stage [%s] has %d shards' % (self.stage.name, len(self.shards)))
+
+    def get_rpc(self, server, port):
+        if self.local_workers and server == LocalWorkers.Host:
+            return self.local_workers.for_stage(self.stage.name)
+        return RpcProxy(connection_pool, (server, port), self.stage.name + '.')
+
+    def end_task(self):
+        self.finish_output()
+
+    def fail_task(self):
+        # The pipeline reports the failure and stops its clients itself
+        pass
+
+
+class Pipeline:
+    def __init__(self, stages, work_dir):
+        self.stages = self.ordered(stages)
+        self.work_dir = work_dir
+        self.local_workers = None
+        self.outputs = {}  # Stage name -> its final shards
+        self.states = dict([(stage.name, 'waiting') for stage in self.stages])
+        self.current = None  # StageMothership of the stage running now
+
+    def ordered(self, stages):
+        """
+        stages, and any they depend on, with every stage after the ones it
+        reads
+        """
+        order = []
+        def visit(stage, path):
+            if stage in path:
+                raise ValueError('Pipeline stages %s form a cycle' %
+                        ' -> '.join([s.name for s in path + [stage]]))
+            if stage not in order:
+                for other in stage.depends():
+                    visit(other, path + [stage])
+                order.append(stage)
+        for stage in stages:
+            visit(stage, [])
+        return order
+
+    def stage_dir(self, stage):
+        return '%s/%s' % (self.work_dir, stage.name)
+
+    def manifest_path(self, stage):
+        return '%s/%s.stage.json' % (self.work_dir, stage.name)
+
+    def input_shards(self, stage):
+        shards = []
+        for source in stage.inputs:
+            if isinstance(source, Stage):
+                shards.extend(self.outputs[source.name])
+            else:
+                shards.extend(list_shards(source))
+        return sorted(shards)
+
+    def side_files(self, stage):
+        return [isinstance(source, Stage) and source.output or source for source in stage.uses]
+
+    def fingerprint(self, stage, shards):
+        """
+        Hash of what a stage's output depends on: the source of its job, its
+        settings, and the names, sizes and times of its input and side files
+        """
+        digest = hashlib.sha1()
+        digest.update(repr((stage.mapper.__name__, stage.args, stage.shuffle, stage.output,
+            sorted(stage.options.items()), ufo.ShufflePartitions)))
+        digest.update(open(inspect.getsourcefile(stage.mapper)).read())
+        for path in shards + self.side_files(stage):
+            digest.update('%s %d %r\n' % (path, os.path.getsize(path), os.path.getmtime(path)))
+        return digest.hexdigest()
+
+    def up_to_date(self, stage, fingerprint):
+        """
+        The shards a previous run of stage left, if that run had the same
+        fingerprint and they are all still there, else None
+        """
+        path = self.manifest_path(stage)
+        if not os.path.exists(path):
+            return None
+        try:
+            manifest = to_bytes(json.load(open(path)))
+        except ValueError:
+            return None
+        files = manifest['shards'] + (stage.output and [stage.output] or [])
+        if manifest['fingerprint'] != fingerprint or not all([os.path.exists(f) for f in files]):
+            return None
+        return manifest['shards']
+
+    def run_stage(self, stage, shards, fingerprint):
+        if not os.path.exists(self.stage_dir(stage)):
+            os.makedirs(self.stage_dir(stage))
+
+        mothership = StageMothership(stage, self.work_dir)
+        mothership.local_workers = self.local_workers
+        self.current = mothership
+        mothership.start_task(self.stage_dir(stage), shards)
+        mothership.start()
+        mothership.join()
+        self.current = None
+        if mothership.failed:
+            self.states[stage.name] = 'failed'
+            raise StageFailed('Stage [%s]: %s' % (stage.name, mothership.failed))
+
+        out = open(self.manifest_path(stage), 'w')
+        json.dump({'stage':stage.name, 'fingerprint':fingerprint,
+            'shards':mothership.shuffle_result_shards, 'counters':mothership.counters}, out, indent=2)
+        out.close()
+        return mothership.shuffle_result_shards
+
+    def run(self, processes=None):
+        """
+        Run every stage that isn't up to date, with processes local workers or
+        else whichever clients join
+        """
+        if not os.path.exists(self.work_dir):
+            os.makedirs(self.work_dir)
+        if processes:
+            stages = self.stages
+            self.local_workers = LocalWorkers(lambda mothership, args: PipelineWorker(mothership, args, stages),
+                    [], processes)
+            self.local_workers.register()
+        else:
+            registry = ClientRegistry()
+            registry.daemon = True
+            registry.start()
+        if ufo.StatusPort:
+            StatusServer(ufo.StatusPort, self.status, ufo.StatusHost).start()
+
+        try:
+            for stage in self.stages:
+                shards = self.input_shards(stage)
+                fingerprint = self.fingerprint(stage, shards)
+                outputs = self.up_to_date(stage, fingerprint)
+                if outputs is not None:
+                    logger.info('Stage [%s] is up to date' % stage.name)
+                    self.states[stage.name] = 'skipped'
+                else:
+                    logger.info('Running stage [%s]' % stage.name)
+                    self.states[stage.name] = 'running'
+                    outputs = self.run_stage(stage, shards, fingerprint)
+                    self.states[stage.name] = 'done'
+                self.outputs[stage.name] = outputs
+        finally:
+            # Only now are the clients done with
+            closer = ufo.Mothership()
+            closer.local_workers = self.local_workers
+            closer.terminate_servers()
+
+    def status(self):
+        snapshot = {'stages':[{'name':stage.name, 'state':self.states[stage.name]}
+            for stage in self.stages]}
+        current = self.current
+        if current:
+            snapshot['stage'] = current.stage.name
+            snapshot.update(current.status())
+        return snapshot
+
+
+def start_pipeline(pipeline):
+    """
+    start_ufo for a pipeline: run a client with --client mothership
+    [--slots N] or else the pipeline itself, with --local N to run it all on
+    this machine
+    """
+    if len(sys.argv) > 1 and sys.argv[1] == '--client':
+        if len(sys.argv) < 3:
+            print "usage: %s --client 'mothership' [--slots N]" % sys.argv[0]
+            sys.exit()
+        args = sys.argv[3:]
+        if len(args) > 1 and args[0] == '--slots':
+            PipelineWorker.Slots = int(args[1])
+            args = args[2:]
+        PipelineWorker(sys.argv[2], args, pipeline.stages).serve()
+    else:
+        processes = None
+        if len(sys.argv) > 2 and sys.argv[1] == '--local':
+            processes = int(sys.argv[2])
+        try:
+            pipeline.run(processes)
+        except StageFailed, detail:
+            logger.error( 'Pipeline failed: %s' % detail )
+            sys.exit(1)
+        logger.info('done.')
+        sys.exit()
@@ -0,0 +1,57 @@
+"""
+Range partitioning for jobs whose output should come out globally sorted, in
+the way TeraSort does it. Before the map phase a few map tokens are run, each
+keeping a uniform random sample of the keys of all the records it outputs
+(a prefix would do for shuffled input, but mappers that output in key order,
+like those using an Aggregator, would only show their smallest keys); from
+those samples the Mothership picks ShufflePartitions - 1 boundary keys so that each reduce
+partition gets about the same number of records. A map output record goes to
+the first partition whose boundary is at or above its key, so the partitions
+are in key order and the final shards, each sorted, can simply be put one
+after another.
+
+A key can't be split between reducers, so a key that makes up a large part
+of the sample (a common word, say) gets a partition to itself and the
+boundaries after it are spread over the rest of the sample.
+"""
+from bisect import bisect_right
+from random import randrange
+
+class KeySampler:
+    """
+    Stands in for the Mapper's ExternalSorter while sampling: it keeps a
+    reservoir of size keys, each record added having the same chance of
+    being in it
+    """
+    def __init__(self, size, key):
+        self.size = size
+        self.key = key
+        self.keys = []
+        self.seen = 0  # Records added so far
+
+    def add(self, record, partition=0):
+        self.seen += 1
+        if len(self.keys) < self.size:
+            self.keys.append(self.key(record))
+        else:
+            i = randrange(self.seen)
+            if i < self.size:
+                self.keys[i] = self.key(record)
+
+def pick_boundaries(sample, partitions):
+    """
+    Up to partitions - 1 sorted keys splitting sample into runs of about
+    equal length, never splitting equal keys. Partition i holds the keys
+    above boundary i - 1 and up to boundary i.
+    """
+    sample = sorted(sample)
+    boundaries = []
+    start = 0
+    for remaining in range(partitions, 1, -1):
+        if start >= len(sample):
+            break
+        end = start + max((len(sample) - start) // remaining, 1)
+        boundary = sample[end - 1]
+        boundaries.append(boundary)
+        start = bisect_right(sample, boundary, end - 1)
+    return boundaries
@@ -0,0 +1,206 @@
+"""
+Side files (term frequencies, stop words, link counts, ...) shared by every
+worker on a host. Rather than each worker reading a side file into sets and
+dicts of its own, the first one to ask converts it into a hash table on local
+disk and everyone maps that file into memory read-only, so there is one copy
+of the data per host in the page cache whatever the number of workers.
+
+A table is built from the tab separated lines of its source: the first field
+is the key and the rest are converted with the given types into the value
+tuple. Its header records the source's size and mtime and the types, and a
+table that no longer matches is rebuilt the next time it is opened.
+
+The file is a header, then a slot array of (crc32 of key, offset of record)
+pairs probed linearly, then the records, each a length prefixed key followed
+by the marshalled value.
+"""
+import os, json, mmap, marshal, struct, fcntl, tempfile, zlib
+from inputs import InputReader
+from journal import to_bytes
+
+Magic = 'UFOTABLE'
+Version = 1
+Slot = struct.Struct('<IQ')  # Hash and record offset; offset 0 means empty
+Length = struct.Struct('<I')
+
+def table_path(directory, source, types):
+    """
+    Where the table for source with these value types lives in directory
+    """
+    name = '%s\t%s' % (os.path.abspath(source), ','.join([t.__name__ for t in types]))
+    return os.path.join(directory, '%08x-%s.table' % (zlib.crc32(name) & 0xffffffff,
+        os.path.basename(source)))
+
+def describe(source, types):
+    """
+    What a table built now from source would record in its header
+    """
+    stat = os.stat(source)
+    return {'version':Version, 'source':os.path.abspath(source), 'size':stat.st_size,
+            'mtime':stat.st_mtime, 'types':[t.__name__ for t in types]}
+
+def read_header(path):
+    """
+    The header of the table at path, or None if it isn't a table
+    """
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        if f.read(len(Magic)) != Magic:
+            return None
+        (length,) = Length.unpack(f.read(Length.size))
+        header = to_bytes(json.loads(f.read(length)))
+        header['start'] = len(Magic) + Length.size + length
+        return header
+    except (struct.error, ValueError):
+        return None
+    finally:
+        f.close()
+
+def build_table(source, path, types):
+    """
+    Convert source into a table at path
+    """
+    rows = {}
+    for line in InputReader(source):
+        fields = line.rstrip('\n').split('\t')
+        if fields[0]:
+            rows[fields[0]] = tuple([t(field) for (t, field) in zip(types, fields[1:])])
+
+    slots = 2
+    while slots < 2 * len(rows):
+        slots *= 2
+    header = describe(source, types)
+    header['slots'] = slots
+    header = json.dumps(header)
+    start = len(Magic) + Length.size + len(header)
+    table = [(0, 0)] * slots
+
+    (fd, temp_path) = tempfile.mkstemp(prefix='.table-', dir=os.path.dirname(path))
+    f = os.fdopen(fd, 'wb')
+    f.write(Magic + Length.pack(len(header)) + header)
+    f.seek(start + slots * Slot.size)
+    offset = f.tell()
+    for (key, value) in rows.iteritems():
+        hash = zlib.crc32(key) & 0xffffffff
+        i = hash & (slots - 1)
+        while table[i][1]:
+            i = (i + 1) & (slots - 1)
+        table[i] = (hash, offset)
+        value = marshal.dumps(value)
+        record = Length.pack(len(key)) + key + Length.pack(len(value)) + value
+        f.write(record)
+        offset += len(record)
+    f.seek(start)
+    f.write(''.join([Slot.pack(*slot) for slot in table]))
+    f.close()
+    os.rename(temp_path, path)
+
+
+class SideTable:
+    """
+    Read-only dict-like view of a table, mapping each key to its tuple of
+    values. The file is only mapped on first use. Unicode keys are looked up
+    by their utf8 bytes.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+
+    def open(self):
+        header = read_header(self.path)
+        f = open(self.path, 'rb')
+        self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        self.start = header['start']
+        self.slots = header['slots']
+
+    def get(self, key, default=None):
+        if self.data is None:
+            self.open()
+        if isinstance(key, unicode):
+            key = key.encode('utf8')
+        hash = zlib.crc32(key) & 0xffffffff
+        mask = self.slots - 1
+        i = hash & mask
+        while True:
+            (slot_hash, offset) = Slot.unpack_from(self.data, self.start + i * Slot.size)
+            if not offset:
+                return default
+            if slot_hash == hash:
+                (length,) = Length.unpack_from(self.data, offset)
+                offset += Length.size
+                if self.data[offset:offset+length] == key:
+                    offset += length
+                    (length,) = Length.unpack_from(self.data, offset)
+                    offset += Length.size
+                    return marshal.loads(self.data[offset:offset+length])
+            i = (i + 1) & mask
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def where(self, predicate):
+        """
+        A set-like view of the keys for which predicate(key, value) holds
+        """
+        return FilteredTable(self, predicate)
+
+    def column(self, index, default=0):
+        """
+        A dict-like view of field index of each value, default for missing keys
+        """
+        return TableColumn(self, index, default)
+
+class FilteredTable:
+    def __init__(self, table, predicate):
+        self.table = table
+        self.predicate = predicate
+
+    def __contains__(self, key):
+        value = self.table.get(key)
+        return value is not None and bool(self.predicate(key, value))
+
+class TableColumn:
+    def __init__(self, table, index, default):
+        self.table = table
+        self.index = index
+        self.default = default
+
+    def __getitem__(self, key):
+        value = self.table.get(key)
+        if value is None:
+            return self.default
+        return value[self.index]
+
+
+def open_table(source, types, directory):
+    """
+    A SideTable for source, building it in directory first unless an up to
+    date one is already there. Workers on a host take turns through a lock
+    file so only the first one builds it.
+    """
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass  # Another worker on this host got there first
+    path = table_path(directory, source, types)
+    lock = open(path + '.lock', 'a')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        header = read_header(path)
+        expected = describe(source, types)
+        if header is None or any([header.get(k) != v for (k, v) in expected.items()]):
+            build_table(source, path, types)
+    finally:
+        lock.close()
+    return SideTable(path)
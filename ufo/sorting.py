@@ -0,0 +1,126 @@
+"""
+External sorting helpers used by the Mapper. Output lines are held in memory
+until a byte budget is reached and then spilled to disk as sorted runs; the
+runs are merged back lazily so memory stays bounded no matter how much output
+a single map or shuffle token produces.
+
+Records are (partition, line) pairs so that a single sort orders the output
+by partition first and by line within each partition. Jobs using binary
+records (see records) have tuples of fields in place of lines.
+"""
+import os, tempfile
+from heapq import merge
+from itertools import groupby
+from records import TextFormat
+
+Text = TextFormat()
+
+def write_run(records, spill_dir=None, format=Text):
+    """
+    Write an already sorted sequence of (partition, line) records to a
+    temporary run file and return its path
+    """
+    (fd, path) = tempfile.mkstemp(prefix='ufo-run-', suffix=format.Extension, dir=spill_dir)
+    f = os.fdopen(fd, 'wb')
+    for (partition, line) in records:
+        format.write_tagged(f, partition, line)
+    f.close()
+    return path
+
+def read_run(path, remove=False, format=Text):
+    """
+    Lazily yield the records of a run file. If remove is set the file is
+    unlinked as soon as it is opened.
+    """
+    f = open(path, 'rb')
+    if remove:
+        os.remove(path)
+    for record in format.read_tagged(f):
+        yield record
+    f.close()
+
+def combine_records(records, key, combine, format=Text, fields=1):
+    """
+    Run a job's combiner over sorted (partition, line) records. Consecutive
+    lines with the same partition and key are handed to combine(key, values)
+    as the part of the line after the key, and each value it returns is
+    turned back into a line. fields is the job's KeyFields, which binary
+    records need to tell the key from the value.
+    """
+    for ((partition, k), group) in groupby(records, lambda (p, line): (p, key(line))):
+        values = (format.value(line, k, fields) for (_, line) in group)
+        for value in sorted(combine(k, values)):
+            yield (partition, format.make(k, value, fields))
+
+def merge_runs(streams, fan_in, spill_dir=None, format=Text):
+    """
+    k-way merge of sorted streams. At most fan_in streams are open at once;
+    when there are more, groups of them are first merged into intermediate
+    runs on disk. Streams should be generators that have not been started yet
+    so that their files are only opened when they are actually merged.
+    """
+    streams = list(streams)
+    while len(streams) > fan_in:
+        path = write_run(merge(*streams[:fan_in]), spill_dir, format)
+        streams = streams[fan_in:] + [read_run(path, True, format)]
+    return merge(*streams)
+
+
+class ExternalSorter:
+    """
+    Collects unicode lines tagged with a partition and hands them back as
+    sorted (partition, line) records, spilling a sorted run to disk whenever
+    more than budget bytes are buffered.
+    """
+    def __init__(self, budget, spill_dir=None, fan_in=100, combiner=None, format=Text):
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self.fan_in = fan_in
+        self.format = format
+        self.combiner = combiner  # Applied to sorted records before they are
+                                  # spilled and again when runs are merged
+
+        self.buffer = []
+        self.buffered = 0  # Approximate size of the buffer in bytes
+        self.runs = []  # Paths of the runs spilled so far
+
+    def add(self, line, partition=0):
+        self.buffer.append((partition, line))
+        self.buffered += self.format.size(line)
+        if self.buffered >= self.budget:
+            self.spill()
+
+    def spill(self):
+        """
+        Sort the in-memory buffer and write it out as a new run
+        """
+        if self.buffer:
+            self.buffer.sort()
+            records = self.buffer
+            if self.combiner:
+                records = self.combiner(records)
+            self.runs.append(write_run(records, self.spill_dir, self.format))
+            self.buffer = []
+            self.buffered = 0
+
+    def __iter__(self):
+        """
+        Merge the spilled runs with whatever is still buffered
+        """
+        self.buffer.sort()
+        streams = [iter(self.buffer)] + [read_run(path, False, self.format) for path in self.runs]
+        records = merge_runs(streams, self.fan_in, self.spill_dir, self.format)
+        if self.combiner:
+            records = self.combiner(records)
+        return records
+
+    def close(self):
+        """
+        Remove any runs left on disk
+        """
+        for path in self.runs:
+            if os.path.exists(path):
+                os.remove(path)
+        self.runs = []
+        self.buffer = []
+        self.buffered = 0
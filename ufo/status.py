@@ -0,0 +1,57 @@
+"""
+A small HTTP server on the Mothership showing how a job is getting on. GET /
+(or /status) returns a JSON snapshot of the tokens pending, running and done,
+how long each running token has taken so far, the slowest of them, each
+worker's throughput and an estimate of when the current phase will finish:
+
+    curl -s http://localhost:8642/ | python -m json.tool
+
+The page says what every client is running and where, so it is only served
+to the Mothership's own host unless StatusHost says otherwise.
+"""
+import json, threading, socket
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from utils import logger
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class StatusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/status'):
+            self.send_error(404)
+            return
+        try:
+            body = json.dumps(self.server.snapshot(), indent=2, sort_keys=True)
+        except Exception, detail:
+            logger.warning('Could not build status: %r' % detail)
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('status: ' + format % args)
+
+
+class StatusServer(threading.Thread):
+    """
+    Serve the dict returned by snapshot() as JSON on port of the interface
+    host ('' is all of them)
+    """
+    def __init__(self, port, snapshot, host='localhost'):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.server = ThreadingHTTPServer((host, port), StatusHandler)
+        self.server.snapshot = snapshot
+        self.host = host
+
+    def run(self):
+        logger.info('Serving job status at http://%s:%d/' % (self.host or socket.gethostname(),
+                self.server.server_port))
+        self.server.serve_forever()
@@ -0,0 +1,173 @@
+"""
+The RPC transport used between the Mothership and its clients. Every message
+is a 4 byte big-endian length followed by a marshalled payload: requests are
+(method, args) tuples and replies are (ok, result) tuples. Connections are
+long lived; clients keep a pool of idle connections to each server and a
+server handles each connection in its own thread until it is closed.
+
+Anyone who can reach a port can send it messages, so they are marshalled
+rather than pickled: unpickling runs whatever the sender asks for. This
+limits arguments and results to the types marshal handles (None, numbers,
+strings, tuples, lists, dicts and sets of them).
+"""
+import socket, struct, select, threading
+import marshal
+from SocketServer import ThreadingTCPServer, BaseRequestHandler
+
+ConnectTimeout = 10.0  # Seconds to wait when opening a new connection
+
+class RemoteError(Exception):
+    """ Raised on the calling side when the remote method raised """
+    pass
+
+def send_message(sock, obj):
+    data = marshal.dumps(obj)
+    sock.sendall(struct.pack('!I', len(data)) + data)
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1024 * 1024))
+        if not chunk:
+            raise EOFError('Connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def recv_message(sock):
+    (size,) = struct.unpack('!I', recv_exactly(sock, 4))
+    return marshal.loads(recv_exactly(sock, size))
+
+
+class RpcHandler(BaseRequestHandler):
+    """ Serves calls on one connection until the other end hangs up """
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        meta = {'client_address': self.client_address}
+        while True:
+            try:
+                (method, args) = recv_message(sock)
+            except (EOFError, socket.error):
+                return
+            except (ValueError, TypeError):
+                return  # Not a message of ours, so hang up
+
+            try:
+                reply = (True, self.server.methods[method](meta, *args))
+            except Exception, detail:
+                reply = (False, '%s: %s' % (detail.__class__.__name__, detail))
+
+            try:
+                try:
+                    send_message(sock, reply)
+                except ValueError, detail:
+                    # The method returned something marshal can't send
+                    send_message(sock, (False, 'ValueError: %s' % detail))
+            except socket.error:
+                return
+
+class RpcServer(ThreadingTCPServer):
+    """
+    Dispatches calls to registered methods. As with the old XML-RPC server
+    each method is called with a meta dict followed by the call's arguments.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address):
+        ThreadingTCPServer.__init__(self, address, RpcHandler)
+        self.methods = {}
+
+    def register(self, name, method):
+        self.methods[name] = method
+
+
+class ConnectionPool:
+    """ Keeps idle connections to each server open between calls """
+    def __init__(self):
+        self.idle = {}  # (server, port) -> list of idle sockets
+        self.lock = threading.Lock()
+
+    def checkout(self, address):
+        """
+        Returns a connection to address and whether it was reused
+        """
+        while True:
+            self.lock.acquire()
+            try:
+                if not self.idle.get(address):
+                    break
+                sock = self.idle[address].pop()
+            finally:
+                self.lock.release()
+            # An idle connection has nothing to read unless the server has
+            # closed it
+            poller = select.poll()
+            poller.register(sock, select.POLLIN)
+            if not poller.poll(0):
+                return (sock, True)
+            sock.close()
+
+        sock = socket.create_connection(address, ConnectTimeout)
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return (sock, False)
+
+    def checkin(self, address, sock):
+        self.lock.acquire()
+        try:
+            self.idle.setdefault(address, []).append(sock)
+        finally:
+            self.lock.release()
+
+    def discard(self, address):
+        """
+        Close every idle connection to address, e.g. when it has gone away
+        """
+        self.lock.acquire()
+        try:
+            socks = self.idle.pop(address, [])
+        finally:
+            self.lock.release()
+        for sock in socks:
+            sock.close()
+
+    def call(self, address, method, args):
+        (sock, reused) = self.checkout(address)
+        try:
+            try:
+                send_message(sock, (method, args))
+            except socket.error:
+                if not reused:
+                    raise
+                # The server dropped an idle connection; it's safe to try
+                # again on a fresh one since it never saw the call. Once the
+                # call is sent it may have run, so errors after that aren't
+                # retried.
+                sock.close()
+                self.discard(address)
+                (sock, _) = self.checkout(address)
+                send_message(sock, (method, args))
+            (ok, result) = recv_message(sock)
+        except:
+            sock.close()
+            raise
+        self.checkin(address, sock)
+
+        if not ok:
+            raise RemoteError(result)
+        return result
+
+class RpcProxy:
+    """
+    Turns attribute calls into calls on a remote server, with prefix put in
+    front of every method name
+    """
+    def __init__(self, pool, address, prefix=''):
+        self.pool = pool
+        self.address = address
+        self.prefix = prefix
+
+    def __getattr__(self, method):
+        return lambda *args: self.pool.call(self.address, self.prefix + method, args)
@@ -4,24 +4,33 @@ from sim import *
 import codecs
 from bz2 import *
 
-def get_document_iterator(source_type, file, BannedArticleTypes=[]):
-    f = codecs.getreader('utf8')(BZ2File(file))
+def get_document_iterator(source_type, file, BannedArticleTypes=[], counter=None):
+    """
+    file is either the path of a bz2 file or an already opened utf8 reader,
+    e.g. from Mapper.open_input. counter, e.g. Mapper.counter, is passed on
+    to the cleaner to count documents.
+    """
+    if isinstance(file, basestring):
+        f = codecs.getreader('utf8')(BZ2File(file))
+    else:
+        f = file
     if source_type == 'wikipedia':
-        documents = enumerate(clean_wikipedia_documents(f, BannedArticleTypes))
+        documents = enumerate(clean_wikipedia_documents(f, BannedArticleTypes,
+            counter=counter))
     elif source_type == 'wikipedia-strict':
         documents = enumerate(clean_wikipedia_documents(f, BannedArticleTypes,
-            filter_extraneous=True))
+            filter_extraneous=True, counter=counter))
     elif source_type == 'wikipedia-nospace':
         documents = enumerate(clean_wikipedia_documents(f, BannedArticleTypes,
-            space_punctuation=False))
+            space_punctuation=False, counter=counter))
     elif source_type == 'wikipedia-strict-nospace':
         documents = enumerate(clean_wikipedia_documents(f, BannedArticleTypes,
-            filter_extraneous=True, space_punctuation=False))
+            filter_extraneous=True, space_punctuation=False, counter=counter))
     elif source_type == 'gigaword':
-        documents = enumerate(clean_gigaword_documents(f))
+        documents = enumerate(clean_gigaword_documents(f, counter=counter))
     elif source_type == 'gigaword-nospace':
         documents = enumerate(clean_gigaword_documents(f,
-            space_punctuation=False))
+            space_punctuation=False, counter=counter))
     elif source_type == 'plain':
         documents = enumerate([x.replace('\n','') for x in f.readlines()])
     else:
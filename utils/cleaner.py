@@ -138,30 +138,45 @@ def filter_strict(words):
 
 
 def clean_wikipedia_documents(f, BannedArticleTypes, filter_extraneous=False,
-        space_punctuation=False):
+        space_punctuation=False, counter=None):
     return map_over_wikipedia_documents(clean_document_keep_punctuation,
             f, BannedArticleTypes, filter_extraneous, parse_mediawiki=True,
-            space_punctuation=space_punctuation) 
+            space_punctuation=space_punctuation, counter=counter) 
 
-def clean_gigaword_documents(f, space_punctuation=True):
+def clean_gigaword_documents(f, space_punctuation=True, counter=None):
     return map_over_gigaword_documents(clean_document_keep_punctuation, f,
-            space_punctuation=space_punctuation)
+            space_punctuation=space_punctuation, counter=counter)
 
-def extract_links(f, BannedArticleTypes):
+def extract_links(f, BannedArticleTypes, counter=None):
     return map_over_wikipedia_documents(re_extract_links, f, BannedArticleTypes,
-            parse_mediawiki=False) 
+            parse_mediawiki=False, counter=counter) 
 
-def extract_categories(f, BannedArticleTypes):
+def extract_categories(f, BannedArticleTypes, counter=None):
     return map_over_wikipedia_documents(re_extract_categories, f, BannedArticleTypes,
-            parse_mediawiki=False) 
+            parse_mediawiki=False, counter=counter) 
 
 re_redirect = re.compile('\#redirect|\#REDIRECT')
 
-def map_over_wikipedia_documents(function, f, BannedArticleTypes, filter_extraneous=False, parse_mediawiki=True, space_punctuation=False): 
+def set_record_start(f, marker):
+    """
+    Tell a reader over part of a dump (ufo.inputs.InputReader) which lines
+    begin a document, so it starts and stops on whole documents
+    """
+    if hasattr(f, 'set_record_start'):
+        f.set_record_start(marker)
+
+def no_counter(group, name, delta=1):
+    pass
+
+def map_over_wikipedia_documents(function, f, BannedArticleTypes, filter_extraneous=False, parse_mediawiki=True, space_punctuation=False, counter=None): 
     """
     This generator returns cleaned documents read from the input stream 
-    one at a time.
+    one at a time. counter, e.g. Mapper.counter, is told how many documents
+    were read, banned and failed to parse.
     """
+    set_record_start(f, '<page>')
+    counter = counter or no_counter
+
     inside_body = False  # are we inside the body text or not
     buffer = []
 
@@ -181,8 +196,11 @@ def map_over_wikipedia_documents(function, f, BannedArticleTypes, filter_extrane
 
             if line.find('</text>') >= 0:
                 inside_body = False
+                counter('documents', 'read')
 
-                if not [1 for x in BannedArticleTypes if current_title and current_title.startswith(x)]:
+                if [1 for x in BannedArticleTypes if current_title and current_title.startswith(x)]:
+                    counter('documents', 'banned')
+                else:
                     # print strip_html(strip_html(''.join(buffer))).encode('utf8','ignore')
                     # print (''.join(buffer)).encode('utf8','replace')
                     temp = strip_html(strip_html(''.join(buffer))) 
@@ -198,6 +216,7 @@ def map_over_wikipedia_documents(function, f, BannedArticleTypes, filter_extrane
                     except (IndexError, ImportError, RuntimeError):
                         # print (''.join(buffer)).encode('utf8','ignore')
                         sys.stderr.write('-------------------- failed to MW parse [%s]\n' % current_title.encode('utf8','ignore'))
+                        counter('documents', 'parse failures')
                         buffer = []
                         continue
                     clean = function(temp, current_title,
@@ -205,6 +224,7 @@ def map_over_wikipedia_documents(function, f, BannedArticleTypes, filter_extrane
 
                     if filter_extraneous:
                         clean = ' '.join(filter_non_content(clean.split(' ')))
+                    counter('documents', 'used')
                     yield (current_title, clean, links, flags)
 
                 # Reset for the next document
@@ -213,7 +233,7 @@ def map_over_wikipedia_documents(function, f, BannedArticleTypes, filter_extrane
             f.close()
             break
 
-def map_over_gigaword_documents(function, f, space_punctuation=True):
+def map_over_gigaword_documents(function, f, space_punctuation=True, counter=None):
     """
     This generator returns cleaned documents read from the input stream 
     one at a time.
@@ -227,7 +247,11 @@ def map_over_gigaword_documents(function, f, space_punctuation=True):
      </DATELINE>
      <TEXT>
 
+    counter works as for map_over_wikipedia_documents.
     """
+    set_record_start(f, '<DOC')
+    counter = counter or no_counter
+
     inside_body = False  # are we inside the body text or not
     inside_title = False
     buffer = []
@@ -258,6 +282,7 @@ def map_over_gigaword_documents(function, f, space_punctuation=True):
 
             if line.find('</TEXT>') >= 0:
                 inside_body = False
+                counter('documents', 'read')
 
                 try:
                     # print strip_html(strip_html(''.join(buffer))).encode('utf8','ignore')
@@ -268,9 +293,11 @@ def map_over_gigaword_documents(function, f, space_punctuation=True):
                 except (IndexError, ImportError):
                     # print (''.join(buffer)).encode('utf8','ignore')
                     sys.stderr.write('-------------------- failed to parse [%s]\n' % current_title.encode('utf8','ignore'))
+                    counter('documents', 'parse failures')
                     buffer = []
                     continue
 
+                counter('documents', 'used')
                 yield (current_title, clean, [])
 
                 # Reset for the next document